@@ -1,26 +1,132 @@
 #!/usr/bin/python3
+import asyncio
+import base64
+import configparser
+import contextlib
+import contextvars
+import cProfile
 import filecmp
+import functools
+import hashlib
+import hmac
+import fcntl
+import ipaddress
+import math
 import os
+import pstats
+import re
+import resource
+import queue
 import shutil
+import shlex
+import signal
 import socket
+import sqlite3
+import subprocess
 import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections.abc import MutableMapping
+from dataclasses import dataclass, field, replace
 from getpass import getpass
 from pathlib import Path
 import requests
 import yaml
 import argparse
+import json
 
 VERSION = "0.10.0"
 HOME = str(Path.home())
-PLAYBOOK_DIR = os.path.join(HOME, "playbook")
-PLAYBOOK_VARS_DIR = os.path.join(PLAYBOOK_DIR, "vars")
-COMMON_VARS_FILE = os.path.join(PLAYBOOK_VARS_DIR, "common_configuration.yaml")
+# A controller managing several clusters points these at the directories of one cluster
+PLAYBOOK_DIR = os.environ.get("BIBIGRID_PLAYBOOK_DIR", os.path.join(HOME, "playbook"))
 REQUEST_TIMEOUT=60
-ANSIBLE_HOSTS_FILE = os.path.join(PLAYBOOK_DIR, "ansible_hosts")
-ANSIBLE_HOSTS_ENTRIES = os.path.join(PLAYBOOK_VARS_DIR, "hosts.yaml")
-PLAYBOOK_GROUP_VARS_DIR = os.path.join(PLAYBOOK_DIR, "group_vars")
-HOST_VARS_DIR = os.path.join(PLAYBOOK_DIR, "host_vars")
+GENERATION_MANIFEST = "manifest.json"
 SCALING_TYPE = "manualscaling"
+AUTOSCALING_DUMMY_HOST = "bibigrid-worker-autoscaling-dummy"
+SCALING_STATE_DIR = os.environ.get("BIBIGRID_SCALING_STATE_DIR", os.path.join(HOME, ".scaling"))
+CLUSTER_NAME = os.environ.get("BIBIGRID_CLUSTER_NAME")
+CLUSTER_ID = os.environ.get("BIBIGRID_CLUSTER_ID")
+SSH_PORT = 22
+HOSTNAME_PATTERN = re.compile(
+    r"^(?=.{1,253}$)[A-Za-z0-9](?:[A-Za-z0-9_-]{0,61}[A-Za-z0-9])?(?:\.[A-Za-z0-9](?:[A-Za-z0-9_-]{0,61}[A-Za-z0-9])?)*$"
+)
+GROUP_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_.-]+$")
+CLOUD_INIT_FINISHED_FILE = "/var/lib/cloud/instance/boot-finished"
+READINESS_TIMEOUT = 300
+READINESS_PROBE_TIMEOUT = 5
+READINESS_INITIAL_BACKOFF = 2
+READINESS_MAX_BACKOFF = 30
+KNOWN_HOSTS_FILE = os.path.join(HOME, ".ssh", "known_hosts")
+SSH_CONTROL_DIR = os.path.join(HOME, ".ansible", "cp")
+SSH_CONTROL_PERSIST = "10m"
+TIMING_CALLBACK_NAME = "scaling_timing"
+TIMING_FILES_KEEP = 50
+TIMING_REPORT_SIZE = 10
+HISTORY_REPORT_SIZE = 10
+PLAYBOOK_RETRIES = 2
+RETRY_INITIAL_BACKOFF = 10
+RETRY_MAX_BACKOFF = 60
+PLAYBOOK_TIMEOUT = 4 * 60 * 60
+PLAYBOOK_STALL_TIMEOUT = 15 * 60
+PLAYBOOK_KILL_GRACE = 30
+ANSI_ESCAPE_PATTERN = re.compile(r"\x1b\[[0-9;]*m")
+PLAY_LINE_PATTERN = re.compile(r"^PLAY \[")
+TASK_LINE_PATTERN = re.compile(r"^(?:TASK|RUNNING HANDLER) \[(.*)\]")
+HOST_RESULT_PATTERN = re.compile(r"^(ok|changed|fatal|failed|skipping|unreachable|ignored): \[([^\]\s]+)")
+RECAP_LINE_PATTERN = re.compile(r"^(\S+)\s+: ok=\d+\s+changed=\d+\s+unreachable=(\d+)\s+failed=(\d+)")
+ACCELERATION_FEATURES = ("pipelining", "persistent_connections", "mitogen")
+PIPELINING_FAILURE_MARKERS = ("must have a tty to run sudo", "no tty present")
+MITOGEN_FAILURE_MARKERS = ("mitogen",)
+# Importing the strategy runs the Ansible version check of mitogen
+MITOGEN_PROBE = (
+    "import os, ansible_mitogen.plugins.strategy.mitogen_linear as strategy; "
+    "print(os.path.dirname(strategy.__file__))"
+)
+MITOGEN_PROBE_TIMEOUT = 30
+CONTROLLER_CONFIG_FILE = os.path.join(HOME, ".scaling", "controller.yaml")
+CONTROLLER_CLUSTERS_DIR = os.path.join(HOME, ".scaling", "clusters")
+CONTROLLER_SLOTS_DIR = os.path.join(HOME, ".scaling", "playbook_slots")
+CONTROLLER_INTERVAL = 300
+CONTROLLER_MAX_PLAYBOOKS = 2
+PLAYBOOK_SLOT_POLL_INTERVAL = 5
+SLURM_COALESCE_WINDOW = 10
+# Used when scontrol cannot tell the configured ResumeTimeout
+SLURM_RESUME_TIMEOUT = 900
+SLURM_RESUME_MARGIN = 60
+SLURM_HOOK_TIMEOUT = 10
+HOSTLIST_RANGE_PATTERN = re.compile(r"^(\d+)(?:-(\d+))?$")
+FOLLOW_POLL_INTERVAL = 15
+FOLLOW_IDLE_TIMEOUT = 120
+FOLLOW_TIMEOUT = 2 * 60 * 60
+MASTER_GROUP = "master"
+TASK_ESTIMATE_RUNS = 10
+PROGRESS_REFRESH_INTERVAL = 0.5
+STATUS_FOLLOW_INTERVAL = 0.5
+LIMIT_INLINE_HOSTS = 20
+PROMETHEUS_TEXTFILE_DIR = "/var/lib/prometheus/node-exporter"
+PROFILED_PHASES = (
+    "previous_state",
+    "fetch",
+    "sync",
+    "inventory",
+    "prune_known_hosts",
+    "scan_host_keys",
+    "readiness",
+    "merge_host_keys",
+    "ledger",
+)
+PASSWORD_ENV_VAR = "BIBIGRID_SCALING_PASSWORD"
+KEYRING_SERVICE = "bibigrid-scaling"
+# Root keys used when normalising the records of each state kind, see normalize_for_diff()
+STATE_ROOT_KEYS = {"host_entries": "host_entries", "cluster_cidrs": "cluster_cidrs"}
+# Lists under these keys are compared as sets, extended by order_insensitive_keys in semantic_diff.yaml
+ORDER_INSENSITIVE_KEYS = {"cluster_cidrs", "provider_cidrs", "volumes", "hosts", "host_entries"}
+# Fields whose changes never require a playbook run, extended by ignored_fields in semantic_diff.yaml
+IGNORED_FIELDS = set()
+LIST_MEMBER_KEYS = ("name", "hostname", "id")
+PROFILE_REPORT_SIZE = 25
 CLUSTER_INFO_URL = (
     "https://simplevm.denbi.de/portal/api/autoscaling/{cluster_id}/scale-data/"
 )
@@ -31,260 +137,4135 @@ CLUSTER_OVERVIEW = "https://simplevm.denbi.de/portal/webapp/#/clusters/overview"
 WRONG_PASSWORD_MSG = f"The password seems to be wrong. Please verify it again, otherwise you can generate a new one on the Cluster Overview ({CLUSTER_OVERVIEW})"
 OUTDATED_SCRIPT_MSG = f"Your script is outdated [VERSION: {{SCRIPT_VERSION}} - latest is {{LATEST_VERSION}}] - please download the current script and run it again!\nYou can download the current script via:\n\nwget -O scaling.py {SCALING_SCRIPT_LINK}"
 
+# Written next to the state dir on every playbook run, so the script stays a single downloadable file
+TIMING_CALLBACK_PLUGIN = f'''
+import json
+import os
+import time
+
+from ansible.plugins.callback import CallbackBase
+
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = "aggregate"
+    CALLBACK_NAME = "{TIMING_CALLBACK_NAME}"
+    CALLBACK_NEEDS_ENABLED = False
+
+    def __init__(self):
+        super().__init__()
+        self.output_file = os.environ.get("SCALING_TIMING_FILE")
+        self.started = time.time()
+        self.tasks = {{}}
+        self.host_starts = {{}}
+
+    def _task_entry(self, task):
+        entry = self.tasks.get(task._uuid)
+        if entry is None:
+            role = task._role.get_name() if task._role else None
+            entry = {{"name": task.get_name(), "role": role, "hosts": {{}}}}
+            self.tasks[task._uuid] = entry
+        return entry
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self._task_entry(task)
+
+    def v2_playbook_on_handler_task_start(self, task):
+        self._task_entry(task)
+
+    def v2_runner_on_start(self, host, task):
+        self.host_starts[(host.get_name(), task._uuid)] = time.time()
+
+    def _record(self, result, status):
+        host = result._host.get_name()
+        task = result._task
+        started = self.host_starts.pop((host, task._uuid), None)
+        duration = time.time() - started if started else 0.0
+        self._task_entry(task)["hosts"][host] = [round(duration, 3), status]
+
+    def v2_runner_on_ok(self, result):
+        self._record(result, "changed" if result._result.get("changed") else "ok")
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self._record(result, "ignored" if ignore_errors else "failed")
+
+    def v2_runner_on_skipped(self, result):
+        self._record(result, "skipped")
+
+    def v2_runner_on_unreachable(self, result):
+        self._record(result, "unreachable")
+
+    def v2_playbook_on_stats(self, stats):
+        if not self.output_file:
+            return
+        data = {{
+            "started": self.started,
+            "duration": round(time.time() - self.started, 3),
+            "tasks": list(self.tasks.values()),
+            "stats": {{host: stats.summarize(host) for host in sorted(stats.processed)}},
+        }}
+        tmp_file = self.output_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(tmp_file, self.output_file)
+'''
+
+
+
+class ScalingError(Exception):
+    exit_code = 1
+
+
+class EmptyPasswordError(ScalingError):
+    pass
+
+
+class CredentialsFileError(ScalingError):
+    pass
+
+
+class PortalRequestError(ScalingError):
+    pass
+
+
+class WrongPasswordError(PortalRequestError):
+    pass
+
+
+class OutdatedScriptError(ScalingError):
+    pass
+
+
+class SyncError(ScalingError):
+    pass
+
+
+class PayloadValidationError(ScalingError):
+    def __init__(self, problems):
+        self.problems = problems
+        super().__init__(
+            f"Scale-data payload is invalid ({len(problems)} problems):\n"
+            + "\n".join(f" - {problem}" for problem in problems)
+        )
+
+
+class MemoryBudgetExceededError(ScalingError):
+    pass
+
+
+class ScalingInProgressError(ScalingError):
+    pass
+
+
+class ControllerConfigError(ScalingError):
+    pass
+
+
+class HostlistError(ScalingError):
+    pass
+
+
+class SlurmSetupError(ScalingError):
+    pass
+
+
+class WorkerRecord:
+    # One compact record per worker: JSON strings instead of nested dicts, compared by digest
+    __slots__ = ("hostname", "content", "digest", "volumes_json", "volumes_digest")
+
+    def __init__(self, worker):
+        self.hostname = sys.intern(worker["hostname"])
+        attributes = {key: value for key, value in worker.items() if key != "volumes"}
+        self.content, self.digest = get_state_record("worker", attributes)
+        volumes = worker.get("volumes")
+        if volumes is None:
+            self.volumes_json = self.volumes_digest = None
+        else:
+            self.volumes_json, self.volumes_digest = get_state_record("volumes", {"volumes": volumes})
+
+    @property
+    def volumes(self):
+        return None if self.volumes_json is None else json.loads(self.volumes_json)["volumes"]
+
+    def __eq__(self, other):
+        if not isinstance(other, WorkerRecord):
+            return NotImplemented
+        return (self.hostname, self.digest, self.volumes_digest) == (
+            other.hostname,
+            other.digest,
+            other.volumes_digest,
+        )
+
+    def __hash__(self):
+        return hash((self.hostname, self.digest, self.volumes_digest))
+
+    def __repr__(self):
+        return f"WorkerRecord({self.hostname!r}, digest={self.digest[:8]})"
+
+
+def build_worker_records(workers):
+    return {worker["hostname"]: WorkerRecord(worker) for worker in workers or []}
+
+
+class PlaybookWatchdog:
+    # Follows the streamed playbook output and cuts off hosts that stay behind in a task
+    def __init__(self, process, stall_timeout, addresses, target_hosts=()):
+        self.process = process
+        self.stall_timeout = stall_timeout
+        self.addresses = addresses
+        self.target_hosts = set(target_hosts)
+        self.failed_hosts = set()
+        self.play_hosts = set()
+        self.play_tasks = 0
+        self.task = None
+        self.task_started = None
+        self.task_hosts = set()
+        self.stalled_hosts = set()
+
+    def feed(self, line):
+        line = ANSI_ESCAPE_PATTERN.sub("", line)
+        if PLAY_LINE_PATTERN.match(line):
+            self.play_hosts = set()
+            self.play_tasks = 0
+            self.task = None
+            return
+        match = TASK_LINE_PATTERN.match(line)
+        if match:
+            self.play_tasks += 1
+            self.task = match.group(1)
+            self.task_started = time.monotonic()
+            self.task_hosts = set()
+            return
+        match = HOST_RESULT_PATTERN.match(line)
+        if match:
+            status, host = match.groups()
+            self.task_hosts.add(host)
+            if status in ("fatal", "unreachable"):
+                self.play_hosts.discard(host)
+                self.failed_hosts.add(host)
+            else:
+                self.play_hosts.add(host)
+
+    def check(self, now):
+        # A host only counts as stalled once others finished the task and its ssh client is still running
+        if not self.stall_timeout or self.task is None or not self.task_hosts:
+            return []
+        if now - self.task_started < self.stall_timeout:
+            return []
+        # In the first task of a play, e.g. fact gathering, only the targets of the run tell who is expected
+        expected_hosts = self.play_hosts
+        if self.play_tasks <= 1:
+            expected_hosts = (expected_hosts | self.target_hosts) - self.failed_hosts
+        stalled_hosts = []
+        for host in sorted(expected_hosts - self.task_hosts - self.stalled_hosts):
+            if terminate_host_connections(self.process.pid, self.addresses.get(host, host)):
+                stalled_hosts.append(
+                    f"Watchdog: {host} stalled for {now - self.task_started:.0f}s in task "
+                    f"'{self.task}', cutting it off"
+                )
+                self.stalled_hosts.add(host)
+        return stalled_hosts
+
+
+class PlaybookProgress:
+    # Condenses the streamed playbook output into one status line, estimated from earlier runs
+    def __init__(self, task_estimates):
+        self.estimates = dict(task_estimates)
+        self.tasks_expected = len(task_estimates)
+        self.play = None
+        self.plays = 0
+        self.task = None
+        self.task_started = None
+        self.task_hosts = set()
+        self.play_hosts = set()
+        self.seen_tasks = set()
+        self.tasks_done = 0
+        self.slowest_task = None
+        self.failed_hosts = set()
+        self.host_results = {}
+        self.in_recap = False
+
+    def feed(self, line, now):
+        # Returns whether the line is worth showing above the progress line
+        line = ANSI_ESCAPE_PATTERN.sub("", line)
+        if line.startswith("PLAY RECAP"):
+            self.finish_task(now)
+            self.finish_play()
+            self.in_recap = True
+            return True
+        if self.in_recap:
+            return bool(line.strip())
+        if PLAY_LINE_PATTERN.match(line):
+            self.finish_task(now)
+            self.finish_play()
+            self.plays += 1
+            self.play = line[len("PLAY [") :].split("]", 1)[0]
+            self.play_hosts = set()
+            return False
+        match = TASK_LINE_PATTERN.match(line)
+        if match:
+            self.finish_task(now)
+            self.task = match.group(1)
+            self.task_started = now
+            self.task_hosts = set()
+            self.seen_tasks.add(self.task)
+            return False
+        match = HOST_RESULT_PATTERN.match(line)
+        if match:
+            status, host = match.groups()
+            self.task_hosts.add(host)
+            self.play_hosts.add(host)
+            if status in ("fatal", "unreachable"):
+                self.failed_hosts.add(host)
+                self.host_results[host] = False
+                return True
+            return False
+        return line.startswith(("ERROR!", "[ERROR]"))
+
+    def finish_play(self):
+        # Hosts count as done with every play they come through, the recap has the final word
+        for host in self.play_hosts - self.failed_hosts:
+            self.host_results[host] = True
+
+    def take_host_results(self):
+        host_results = self.host_results
+        self.host_results = {}
+        return host_results.items()
+
+    def finish_task(self, now):
+        if self.task is None:
+            return
+        duration = now - self.task_started
+        if self.slowest_task is None or duration > self.slowest_task[1]:
+            self.slowest_task = (self.task, duration)
+        self.tasks_done += 1
+        self.task = None
+
+    def remaining(self, now):
+        if not self.estimates:
+            return None
+        remaining = sum(
+            duration for task, duration in self.estimates.items() if task not in self.seen_tasks
+        )
+        if self.task is not None:
+            remaining += max(0.0, self.estimates.get(self.task, 0.0) - (now - self.task_started))
+        return remaining
+
+    def render(self, now):
+        parts = [f"play {self.plays} [{self.play}]" if self.play else "starting"]
+        if self.task is not None:
+            total = f"/{self.tasks_expected}" if self.tasks_expected else ""
+            parts.append(
+                f"task {self.tasks_done + 1}{total} {self.task} "
+                f"({format_duration(now - self.task_started)}, "
+                f"{len(self.task_hosts)}/{len(self.play_hosts)} hosts)"
+            )
+        if self.failed_hosts:
+            parts.append(f"{len(self.failed_hosts)} failed")
+        if self.slowest_task:
+            parts.append(f"slowest {self.slowest_task[0]} {format_duration(self.slowest_task[1])}")
+        remaining = self.remaining(now)
+        if remaining is not None:
+            parts.append(f"ETA {format_duration(remaining)}")
+        return " | ".join(parts)
+
+
+@dataclass
+class SyncResult:
+    changed: bool
+    generation: int = 0
+    workers: int = 0
+    changed_fields: list = field(default_factory=list)
+
+
+@dataclass
+class ScalingResult:
+    sync: SyncResult
+    new_hosts: set = field(default_factory=set)
+    deferred_hosts: set = field(default_factory=set)
+    playbook_ran: bool = False
+    playbook_exit_code: int = None
+    failed_hosts: set = field(default_factory=set)
+    playbook_attempts: int = 0
+
+    @property
+    def success(self):
+        return not self.playbook_ran or self.playbook_exit_code == 0
+
+
+@dataclass
+class ScalingOptions:
+    force: bool = False
+    skip_readiness: bool = False
+    readiness_timeout: int = READINESS_TIMEOUT
+    reconverge: bool = False
+    retries: int = PLAYBOOK_RETRIES
+    playbook_timeout: int = PLAYBOOK_TIMEOUT
+    host_stall_timeout: int = PLAYBOOK_STALL_TIMEOUT
+    progress: bool = True
+    follow: int = None
+    # Set for a batch of Slurm power-saving requests, see run_power_batch()
+    resume: frozenset = None
+    suspend: frozenset = None
+    resume_deadline: float = None
+
+
+@dataclass
+class ScalingContext:
+    # The directories of one cluster and the state of its current run, see use_context()
+    playbook_dir: str = PLAYBOOK_DIR
+    state_dir: str = SCALING_STATE_DIR
+    cluster_name: str = CLUSTER_NAME
+    cluster_id: str = CLUSTER_ID
+    metrics: dict = field(default_factory=dict)
+    pending_changes: dict = field(default_factory=lambda: {"writes": {}, "deletes": set()})
+    status: dict = field(default_factory=dict)
+    status_lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.playbook_vars_dir = os.path.join(self.playbook_dir, "vars")
+        self.common_vars_file = os.path.join(self.playbook_vars_dir, "common_configuration.yaml")
+        self.ansible_hosts_file = os.path.join(self.playbook_dir, "ansible_hosts")
+        self.ansible_hosts_entries = os.path.join(self.playbook_vars_dir, "hosts.yaml")
+        self.group_vars_dir = os.path.join(self.playbook_dir, "group_vars")
+        self.host_vars_dir = os.path.join(self.playbook_dir, "host_vars")
+        self.staging_dir = os.path.join(self.playbook_dir, ".scaling-staging")
+        self.previous_generation_dir = os.path.join(self.playbook_dir, ".scaling-previous")
+        self.deferred_hosts_file = os.path.join(self.state_dir, "deferred_hosts.yaml")
+        self.runs_dir = os.path.join(self.state_dir, "runs")
+        self.callback_plugins_dir = os.path.join(self.state_dir, "callback_plugins")
+        self.history_file = os.path.join(self.state_dir, "history.jsonl")
+        self.last_success_file = os.path.join(self.state_dir, "last_success")
+        self.failed_hosts_file = os.path.join(self.state_dir, "failed_hosts.yaml")
+        self.acceleration_file = os.path.join(self.state_dir, "acceleration.yaml")
+        self.slurm_queue_file = os.path.join(self.state_dir, "slurm_queue.json")
+        self.slurm_worker_lock_file = os.path.join(self.state_dir, "slurm_worker.lock")
+        self.slurm_log_file = os.path.join(self.state_dir, "slurm.log")
+        self.status_file = os.path.join(self.state_dir, "status.json")
+        self.detached_log_file = os.path.join(self.state_dir, "scaling.log")
+        self.credentials_file = os.path.join(self.state_dir, "credentials")
+        self.session_token_file = os.path.join(self.state_dir, "session_token")
+        self.state_db_file = os.path.join(self.state_dir, "state.sqlite3")
+        self.semantic_diff_config_file = os.path.join(self.state_dir, "semantic_diff.yaml")
+        self.prometheus_metrics_file = (
+            f"bibigrid_scaling_{self.cluster_name}.prom" if self.cluster_name else "bibigrid_scaling.prom"
+        )
+
+
+class ContextState(MutableMapping):
+    # Resolves to one dict of the current ScalingContext, so runs of different clusters keep apart
+    def __init__(self, name):
+        self.name = name
+
+    def state(self):
+        return getattr(get_context(), self.name)
+
+    def __getitem__(self, key):
+        return self.state()[key]
+
+    def __setitem__(self, key, value):
+        self.state()[key] = value
+
+    def __delitem__(self, key):
+        del self.state()[key]
+
+    def __iter__(self):
+        return iter(self.state())
+
+    def __len__(self):
+        return len(self.state())
+
+    def clear(self):
+        self.state().clear()
+
+
+# The context of the cluster being scaled, the one of this host unless set by use_context()
+DEFAULT_CONTEXT = ScalingContext()
+CURRENT_CONTEXT = contextvars.ContextVar("scaling_context")
+# Counters and phase timings of the current run, reset by reset_run_metrics()
+RUN_METRICS = ContextState("metrics")
+# Playbook files written and deleted by the current sync, applied by commit_changeset()
+PENDING_CHANGES = ContextState("pending_changes")
+# Callables receiving the pstats.Stats of each profiled run, see register_profile_hook()
+PROFILE_HOOKS = []
+# Progress of the current run as shown by "scaling.py status", see update_status()
+RUN_STATUS = ContextState("status")
+
+
+def get_context():
+    return CURRENT_CONTEXT.get(DEFAULT_CONTEXT)
+
+
+@contextlib.contextmanager
+def use_context(context):
+    # Asyncio tasks and to_thread() calls started meanwhile inherit the context
+    token = CURRENT_CONTEXT.set(context)
+    try:
+        yield context
+    finally:
+        CURRENT_CONTEXT.reset(token)
+
 
 def main():
     args = parse_arguments()
     if args.version:
         print(f"Version: {VERSION}")
         sys.exit()
-    if args.password:
-        print("Password provided via arg..")
-        password = args.password
-    else:
-        password = get_password()
-    if args.force:
-        print(f"Force Parameter Provided... Force Playbook Run")
-
-    file_changed = update_all_yml_files(password)
-
-    if file_changed:
-        print("Files changed. Running playbook...")
-        run_ansible_playbook()
-    elif args.force:
-        print("Force run requested. Running playbook...")
-        run_ansible_playbook()
-    else:
-        print(
-            "No changes detected and no force run requested. Skipping playbook execution."
+    if args.command == "history":
+        print_history(args.last)
+        return
+    if args.command == "rollback":
+        if rollback_generation():
+            invalidate_state_store()
+        return
+    if args.command == "state":
+        print_state_changes(args.since, args.kind)
+        return
+    if args.command == "controller":
+        try:
+            config = load_controller_config(args.config)
+            if args.action == "status":
+                print_controller_status(config)
+            else:
+                asyncio.run(run_controller(config, once=args.once))
+        except ScalingError as e:
+            print(e)
+            sys.exit(e.exit_code)
+        return
+    if args.command == "slurm":
+        try:
+            if args.slurm_command == "worker":
+                check_slurm_setup()
+                run_slurm_worker(args.metrics_dir)
+            elif args.slurm_command == "simulate":
+                sys.exit(simulate_slurm_call(args.action, args.nodes, args.timeout, args.wait, args.metrics_dir))
+            else:
+                nodes = expand_hostlist(",".join(args.nodes))
+                try:
+                    check_slurm_setup()
+                except SlurmSetupError as e:
+                    # Failing the nodes now spares Slurm waiting for the whole ResumeTimeout
+                    if args.slurm_command == "resume":
+                        mark_nodes_down(nodes, "bibigrid scaling hook is not set up")
+                    raise
+                queue_slurm_request(args.slurm_command, nodes, args.metrics_dir)
+        except ScalingError as e:
+            print(e)
+            sys.exit(e.exit_code)
+        return
+    if args.command == "status":
+        print_status()
+        if args.follow:
+            follow_log()
+        return
+    try:
+        password = resolve_password(args.password, interactive=sys.stdin.isatty())
+        if args.save_password:
+            store_password(password)
+        if args.force:
+            print(f"Force Parameter Provided... Force Playbook Run")
+        log_file = None
+        if args.detach:
+            # Checked before detaching so a refused run is reported on the terminal
+            check_no_run_in_progress()
+            log_file = get_context().detached_log_file
+            detach(log_file)
+
+        options = ScalingOptions(
+            force=args.force,
+            skip_readiness=args.skip_readiness,
+            readiness_timeout=args.readiness_timeout,
+            # A forced run converges every host again, as it did before the ledger
+            reconverge=args.reconverge or args.force,
+            retries=args.retries,
+            playbook_timeout=args.playbook_timeout,
+            host_stall_timeout=args.host_stall_timeout,
+            progress=not args.no_progress,
+            follow=args.follow,
         )
+        scale(
+            password,
+            options,
+            metrics_dir=args.metrics_dir,
+            profile=args.profile,
+            trace_memory=args.trace_memory,
+            memory_budget=args.memory_budget,
+            log_file=log_file,
+        )
+    except ScalingError as e:
+        print(e)
+        sys.exit(e.exit_code)
 
 
-def parse_arguments():
-    parser = argparse.ArgumentParser(description="Cluster Scaling Script")
-    parser.add_argument(
-        "-v", "--version", action="store_true", help="Show the version and exit"
-    )
-    parser.add_argument("-f", "--force", action="store_true", help="Force Playbook Run")
-    parser.add_argument(
-        "-p", "--password", type=str, required=False, help="Provide Password via Arg"
+def scale(
+    password,
+    options=None,
+    metrics_dir=PROMETHEUS_TEXTFILE_DIR,
+    profile=False,
+    trace_memory=False,
+    memory_budget=None,
+    log_file=None,
+    context=None,
+):
+    # Within a running event loop, await scale_async() instead
+    return asyncio.run(
+        scale_async(password, options, metrics_dir, profile, trace_memory, memory_budget, log_file, context)
     )
-    return parser.parse_args()
 
 
-def get_password():
-    password = getpass("Please enter your cluster password (input will be hidden): ")
-    if not password:
-        print("Password must not be empty!")
-        sys.exit(1)
-    return password
+async def scale_async(
+    password,
+    options=None,
+    metrics_dir=PROMETHEUS_TEXTFILE_DIR,
+    profile=False,
+    trace_memory=False,
+    memory_budget=None,
+    log_file=None,
+    context=None,
+):
+    with use_context(context or get_context()):
+        check_no_run_in_progress()
+        load_semantic_diff_config()
+        reset_run_metrics(profile=profile, trace_memory=trace_memory or bool(memory_budget))
+        reset_run_status(log_file)
+        try:
+            if options and options.follow is not None:
+                result = await run_follow(password, options)
+            elif options and options.resume is not None:
+                result = await run_power_batch(password, options)
+            else:
+                result = await run_scaling(password, options)
+            RUN_METRICS["success"] = result.success
+        except BaseException as e:
+            update_status(last_error=str(e) or repr(e))
+            raise
+        finally:
+            update_status(
+                state="finished" if RUN_METRICS.get("success") else "failed", phase="done", eta=None
+            )
+            finish_profiling()
+            finish_memory_tracing()
+            if RUN_METRICS.get("success"):
+                save_last_success()
+            record_run_history()
+            write_prometheus_metrics(metrics_dir)
 
+        if memory_budget and RUN_METRICS["peak_memory"] > memory_budget * 1024 * 1024:
+            raise MemoryBudgetExceededError(
+                f"Peak traced memory {format_bytes(RUN_METRICS['peak_memory'])} exceeds the budget of {memory_budget} MiB!"
+            )
+        return result
 
-def update_all_yml_files(password):
-    print("Initiating scaling...")
-    data = get_cluster_data(password)
 
-    if not data:
-        print("Failed to retrieve scaling data.")
-        return False
-    groups_vars = data.get("groups_vars", {})
-    hosts_entries = data.get("host_entries", {})
-    ansible_hosts = data.get("ansible_hosts", {})
-    cluster_cidrs = data.get("cluster_cidrs", [])
-    workers_vars = data.get("workers")
-    try:
-        changed_hosts = replace_ansible_hosts(ansible_hosts)
-        print(f"changed hosts --> {changed_hosts}")
-        changed_host_entries = replace_host_entries(hosts_entries)
-        print(f"changed changed_host_entries --> {changed_host_entries}")
+async def run_scaling(password, options=None):
+    options = options or ScalingOptions()
+    # Profiles and memory snapshots are only attributable to a phase when phases do not overlap
+    sequential = RUN_METRICS.get("profiler") is not None or tracemalloc.is_tracing()
+    steps = build_scaling_pipeline(password, options)
+    results = await run_pipeline(steps, sequential=sequential)
+    print_critical_path()
 
-        changed_groups = replace_group_vars(groups_vars)
-        print(f"changed changed_groups --> {changed_groups}")
+    result = ScalingResult(
+        sync=results["sync"],
+        new_hosts=set(results["inventory"]["new_hosts"]),
+        deferred_hosts=results["readiness"],
+    )
+    provisioning = results["playbook"]
+    if "playbook_exit_code" in RUN_METRICS:
+        result.playbook_ran = True
+        result.playbook_exit_code = RUN_METRICS["playbook_exit_code"]
+    if provisioning:
+        result.failed_hosts = provisioning["failed_hosts"] or set()
+        result.playbook_attempts = len(provisioning["timings"])
+        RUN_METRICS["failed_hosts"] = len(result.failed_hosts)
+    return result
 
-        changed_cidrs = replace_cluster_cidrs(new_cidrs=cluster_cidrs)
-        print(f"changed cidr --> {changed_cidrs}")
 
-        changed_volumes = replace_volumes_entries(workers_vars)
-        print(f"changed volumes --> {changed_volumes}")
+async def run_follow(password, options):
+    with timed_phase("follow"):
+        new_hosts = await follow_new_workers(password, options)
+    # The master and every worker not provisioned yet are converged once the batch is complete
+    print("Follow mode finished, running the final scaling pass...")
+    return await run_scaling(password, replace(options, follow=None, force=options.force or bool(new_hosts)))
 
-        return (
-            changed_hosts
-            or changed_host_entries
-            or changed_groups
-            or changed_cidrs
-            or changed_volumes
-        )
 
-    except:
-        print(f"Could not get hosts entries! -- {data}")
-        sys.exit(1)
-    return False
+async def follow_new_workers(password, options):
+    target_workers = options.follow or None
+    loop = asyncio.get_running_loop()
+    known_hosts = set(get_inventory_hosts())
+    new_hosts = {}
+    ready_hosts = {}
+    not_ready_hosts = set()
+    provisioned_hosts = set()
+    failed_hosts = set()
+    waiting = {}
+    # Running provision_batch() tasks and the workers of each batch
+    provisioning = {}
+    batch_exit_codes = []
+    stopping = asyncio.Event()
+    started = last_change = time.monotonic()
 
+    async def wait_for_worker(host, host_vars):
+        deadline = loop.time() + options.readiness_timeout
+        try:
+            ready = options.skip_readiness or await wait_until_ready(
+                host, host_vars, deadline, await asyncio.to_thread(load_host_addresses)
+            )
+        except Exception as e:
+            print(f"Checking whether {host} is ready failed, deferring it: {e!r}")
+            not_ready_hosts.add(host)
+            return
+        if ready:
+            ready_hosts[host] = host_vars
+            dispatch()
+        else:
+            print(f"{host} not ready after {options.readiness_timeout}s, deferring it")
+            not_ready_hosts.add(host)
 
-def replace_volumes_entries(workers_vars):
-    changed = False
+    def dispatch():
+        # Every batch includes the master, so batches run one at a time and ready hosts queue up meanwhile
+        if not ready_hosts or provisioning or stopping.is_set():
+            return
+        batch = dict(ready_hosts)
+        ready_hosts.clear()
+        task = asyncio.ensure_future(provision_batch(batch))
+        provisioning[task] = set(batch)
+        task.add_done_callback(finish_batch)
 
-    expected_files = set()
+    def finish_batch(task):
+        batch = provisioning.pop(task)
+        if not task.cancelled() and task.exception():
+            # Left to the final pass, which retries failed hosts
+            print(f"Provisioning {', '.join(sorted(batch))} failed: {task.exception()!r}")
+            failed_hosts.update(batch)
+        dispatch()
 
-    for worker in workers_vars:
-        hostname = worker.get("hostname")
-        volumes = worker.get("volumes")
+    async def provision_batch(batch):
+        scanned_keys = await scan_host_keys(batch)
+        merge_known_hosts(scanned_keys, get_stale_known_hosts_names(batch, {}))
+        fingerprints = await asyncio.to_thread(get_host_fingerprints, batch)
+        # A worker is only usable once the master has it in /etc/hosts and the scheduler config
+        master_hosts = await asyncio.to_thread(get_master_hosts)
+        target_hosts = set(batch) | master_hosts
+        print(f"Provisioning {len(batch)} workers and the master: {', '.join(sorted(batch))}")
+        result = await asyncio.to_thread(provision_hosts, target_hosts, None, fingerprints, options, False)
+        # Batches do not touch RUN_METRICS["playbook_exit_code"], that is left to the final pass
+        batch_exit_codes.append(result["exit_code"])
+        batch_failed = target_hosts if result["failed_hosts"] is None else result["failed_hosts"]
+        failed_hosts.update(batch_failed)
+        usable_hosts = set() if batch_failed & master_hosts else set(batch) - batch_failed
+        provisioned_hosts.update(usable_hosts)
+        if provisioned_hosts and "first_worker_seconds" not in RUN_METRICS:
+            RUN_METRICS["first_worker_seconds"] = round(time.monotonic() - started, 3)
+        print(
+            f"Provisioned {len(usable_hosts)} of {len(batch)} workers "
+            f"after {format_duration(time.monotonic() - started)}"
+            + (" (the master failed)" if batch_failed & master_hosts else "")
+        )
 
-        if not hostname or volumes is None:
-            continue  # Skip malformed entries
+    print(
+        f"Following scale-data until {target_workers} workers are provisioned..."
+        if target_workers
+        else f"Following scale-data until no new workers appear for {FOLLOW_IDLE_TIMEOUT}s..."
+    )
+    try:
+        while True:
+            try:
+                data = await asyncio.to_thread(get_cluster_data, password)
+            except WrongPasswordError:
+                raise
+            except PortalRequestError as e:
+                print(f"Polling scale-data failed, trying again: {e}")
+                data = None
+            if data:
+                sync = await asyncio.to_thread(sync_cluster_data, data)
+                hosts = await asyncio.to_thread(get_inventory_hosts)
+                master_hosts = await asyncio.to_thread(get_master_hosts)
+                appeared = {
+                    host: host_vars
+                    for host, host_vars in hosts.items()
+                    if host not in known_hosts and host not in master_hosts
+                }
+                if appeared:
+                    print(f"{len(appeared)} new workers appeared: {', '.join(sorted(appeared))}")
+                    last_change = time.monotonic()
+                    known_hosts.update(appeared)
+                    new_hosts.update(appeared)
+                    RUN_METRICS["new_hosts"] = len(new_hosts)
+                    update_status(phase="follow", hosts_total=len(new_hosts))
+                    for host, host_vars in appeared.items():
+                        waiting[host] = asyncio.ensure_future(wait_for_worker(host, host_vars))
+                workers_done = target_workers is None or sync.workers >= target_workers
+            else:
+                workers_done = False
 
-        file_name = f"{hostname}.yaml"
-        file_path = os.path.join(HOST_VARS_DIR, file_name)
-        expected_files.add(file_name)
+            busy = ready_hosts or provisioning or any(not task.done() for task in waiting.values())
+            idle = time.monotonic() - last_change >= FOLLOW_IDLE_TIMEOUT
+            if not busy and workers_done and (target_workers or idle):
+                break
+            if time.monotonic() - started > FOLLOW_TIMEOUT:
+                print(f"Follow mode stopped after {format_duration(FOLLOW_TIMEOUT)}")
+                break
+            await asyncio.sleep(FOLLOW_POLL_INTERVAL)
+    finally:
+        stopping.set()
+        for host, task in waiting.items():
+            if not task.done():
+                task.cancel()
+                not_ready_hosts.add(host)
+        await asyncio.gather(*waiting.values(), *provisioning, return_exceptions=True)
+        # Left for the final pass: it waits for deferred hosts again and retries failed ones
+        save_deferred_hosts(not_ready_hosts | set(ready_hosts))
+        save_failed_hosts(load_failed_hosts() | failed_hosts)
 
-        # Serialize the volumes into YAML format
-        yaml_data = yaml.dump({"volumes": volumes}, default_flow_style=False)
+    print(
+        f"{len(new_hosts)} new workers, {len(provisioned_hosts)} provisioned, "
+        f"{len(failed_hosts)} failed, {len(not_ready_hosts)} not ready, "
+        f"{len(batch_exit_codes)} batches ({sum(1 for code in batch_exit_codes if code)} failed)"
+    )
+    return new_hosts
 
-        # Replace the file if content has changed
-        file_changed = replace_if_changed(file_path, yaml_data)
 
-        if file_changed:
-            changed = True
+def build_scaling_pipeline(password, options):
+    def load_previous_state(results):
+        return {
+            "hosts": get_inventory_hosts(),
+            "deferred_hosts": load_deferred_hosts(),
+            "failed_hosts": load_failed_hosts(),
+        }
 
-    # Remove unexpected files
-    for file in os.listdir(HOST_VARS_DIR):
-        if file.endswith(".yaml") and file not in expected_files:
-            full_path = os.path.join(HOST_VARS_DIR, file)
-            os.remove(full_path)
-            changed = True
+    def fetch(results):
+        print("Initiating scaling...")
+        return get_cluster_data(password)
 
-    return changed
+    def sync(results):
+        # Hand the payload over so the raw worker dicts can be freed once the records are built
+        return sync_cluster_data(results.pop("fetch"), full_sync=options.force)
 
-def replace_group_vars(groups_vars):
-    changed = False
-    expected_files = set()
+    def load_inventory(results):
+        previous_hosts = results["previous_state"]["hosts"]
+        current_hosts = get_inventory_hosts()
+        deferred_hosts = results["previous_state"]["deferred_hosts"] & current_hosts.keys()
+        RUN_METRICS["hosts"] = len(current_hosts)
+        new_hosts = {
+            host: host_vars
+            for host, host_vars in current_hosts.items()
+            if host not in previous_hosts or host in deferred_hosts
+        }
+        RUN_METRICS["new_hosts"] = len(new_hosts)
+        return {
+            "hosts": current_hosts,
+            "new_hosts": new_hosts,
+            "removed_hosts": {
+                host: host_vars
+                for host, host_vars in previous_hosts.items()
+                if host not in current_hosts
+            },
+            "deferred_hosts": deferred_hosts,
+            "failed_hosts": results["previous_state"]["failed_hosts"] & current_hosts.keys(),
+        }
 
-    for key, value in groups_vars.items():
-        if key == "master":
-            continue  # Do not manage master.yaml
+    def prune_known_hosts(results):
+        inventory = results["inventory"]
+        stale_names = get_stale_known_hosts_names(inventory["new_hosts"], inventory["removed_hosts"])
+        if stale_names:
+            print(f"Pruning known_hosts entries for {len(stale_names)} names")
+            merge_known_hosts([], stale_names)
 
-        file_name = f"{key}.yaml"
-        file_path = os.path.join(PLAYBOOK_GROUP_VARS_DIR, file_name)
-        expected_files.add(file_name)
+    async def scan_new_host_keys(results):
+        new_hosts = results["inventory"]["new_hosts"]
+        return await scan_host_keys(new_hosts) if new_hosts else []
 
-        yaml_data = yaml.dump(value, default_flow_style=False)
+    async def wait_for_readiness(results):
+        new_hosts = results["inventory"]["new_hosts"]
+        not_ready_hosts = set()
+        if new_hosts and not options.skip_readiness:
+            not_ready_hosts = await wait_for_new_hosts(new_hosts, options.readiness_timeout)
+        elif new_hosts:
+            print(f"Opening SSH control connections to {len(new_hosts)} new hosts...")
+            await open_control_connections(new_hosts)
+        save_deferred_hosts(not_ready_hosts)
+        RUN_METRICS["deferred_hosts"] = len(not_ready_hosts)
+        return not_ready_hosts
 
-        file_changed = replace_if_changed(file_path, yaml_data)
-        if file_changed:
-            changed = True
+    def merge_host_keys(results):
+        if results["scan_host_keys"]:
+            print(f"Adding {len(results['scan_host_keys'])} scanned host keys to known_hosts")
+            merge_known_hosts(results["scan_host_keys"], set())
 
-    # Clean up unexpected files, except master.yaml
-    for file in os.listdir(PLAYBOOK_GROUP_VARS_DIR):
-        if file.endswith(".yaml") and file not in expected_files and file != "master.yaml":
-            full_path = os.path.join(PLAYBOOK_GROUP_VARS_DIR, file)
-            os.remove(full_path)
-            changed = True
+    def load_ledger(results):
+        inventory = results["inventory"]
+        fingerprints = get_host_fingerprints(inventory["hosts"])
+        converged_hosts = set()
+        if not options.reconverge:
+            converged_hosts = (
+                get_converged_hosts(fingerprints)
+                - inventory["new_hosts"].keys()
+                - inventory["failed_hosts"]
+            )
+        RUN_METRICS["hosts_converged"] = len(converged_hosts)
+        return {"fingerprints": fingerprints, "converged_hosts": converged_hosts}
 
-    return changed
+    def playbook(results):
+        not_ready_hosts = results["readiness"]
+        inventory = results["inventory"]
+        ledger = results["ledger"]
+        failed_hosts = inventory["failed_hosts"] - not_ready_hosts
+        excluded_hosts = not_ready_hosts | ledger["converged_hosts"]
+        if results["sync"].changed:
+            print("Files changed. Running playbook...")
+        elif inventory["deferred_hosts"] - not_ready_hosts:
+            print("Deferred hosts are ready now. Running playbook...")
+        elif options.force:
+            print("Force run requested. Running playbook...")
+        elif options.reconverge:
+            print("Reconverge requested. Running playbook...")
+        elif failed_hosts:
+            print(f"{len(failed_hosts)} hosts failed in the last run. Running playbook for them...")
+            excluded_hosts = None
+        else:
+            print(
+                "No changes detected and no force run requested. Skipping playbook execution."
+            )
+            return None
+        if excluded_hosts is None:
+            target_hosts = failed_hosts
+        else:
+            target_hosts = inventory["hosts"].keys() - excluded_hosts
+        if not target_hosts:
+            print("All hosts are already converged. Skipping playbook execution.")
+            return None
+        if excluded_hosts and ledger["converged_hosts"]:
+            print(
+                f"Skipping {len(ledger['converged_hosts'])} hosts already converged "
+                "(use --reconverge to include them)"
+            )
+        RUN_METRICS["hosts_targeted"] = len(target_hosts)
+        update_status(hosts_total=len(target_hosts), eta=estimate_playbook_eta(len(target_hosts)))
+        provisioning = provision_hosts(target_hosts, excluded_hosts, ledger["fingerprints"], options)
+        RUN_METRICS["playbook_exit_code"] = provisioning["exit_code"]
+        if provisioning["failed_hosts"] is not None:
+            # Failed hosts that could not be targeted this time stay recorded
+            save_failed_hosts(provisioning["failed_hosts"] | (inventory["failed_hosts"] & not_ready_hosts))
+        return provisioning
 
-def replace_host_entries(hosts_entries):
-    return replace_if_changed(
-        ANSIBLE_HOSTS_ENTRIES, yaml.dump(hosts_entries, default_flow_style=False)
-    )
+    return [
+        ("previous_state", (), load_previous_state),
+        ("fetch", (), fetch),
+        # The previous inventory has to be read before the sync replaces it
+        ("sync", ("fetch", "previous_state"), sync),
+        ("inventory", ("sync",), load_inventory),
+        # Stale keys of reused addresses would make the readiness probes fail
+        ("prune_known_hosts", ("inventory",), prune_known_hosts),
+        ("scan_host_keys", ("prune_known_hosts",), scan_new_host_keys),
+        ("readiness", ("prune_known_hosts",), wait_for_readiness),
+        ("merge_host_keys", ("scan_host_keys", "readiness"), merge_host_keys),
+        ("ledger", ("inventory",), load_ledger),
+        ("playbook", ("merge_host_keys", "readiness", "ledger"), playbook),
+    ]
 
 
-def replace_ansible_hosts(ansible_hosts):
-    return replace_if_changed(
-        ANSIBLE_HOSTS_FILE, yaml.dump(ansible_hosts, default_flow_style=False)
-    )
+async def run_pipeline(steps, sequential=False):
+    results = {}
+    spans = {}
+    dependencies = {name: step_dependencies for name, step_dependencies, _ in steps}
+    tasks = {}
+    lock = asyncio.Lock() if sequential else None
 
+    async def run_step(name, step_dependencies, action):
+        await asyncio.gather(*(tasks[dependency] for dependency in step_dependencies))
+        if lock:
+            await lock.acquire()
+        try:
+            started = time.perf_counter()
+            if asyncio.iscoroutinefunction(action):
+                with timed_phase(name):
+                    results[name] = await action(results)
+            else:
+                results[name] = await asyncio.to_thread(run_timed, name, action, results)
+            spans[name] = (started, time.perf_counter())
+        finally:
+            if lock:
+                lock.release()
 
-def replace_cluster_cidrs(new_cidrs: list[str]) -> bool:
-    with open(COMMON_VARS_FILE, "r") as f:
-        data = yaml.safe_load(f)
+    for name, step_dependencies, action in steps:
+        tasks[name] = asyncio.ensure_future(run_step(name, step_dependencies, action))
+    try:
+        await asyncio.gather(*tasks.values())
+    finally:
+        for task in tasks.values():
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                task.exception()  # Failures of dependent steps repeat the first error
+        RUN_METRICS["critical_path"] = get_critical_path(spans, dependencies)
+    return results
 
-    changed = False
-    for cluster in data.get("cluster_cidrs", []):
-        current_cidrs = cluster.get("provider_cidrs", [])
-        if current_cidrs != new_cidrs:
-            cluster["provider_cidrs"] = new_cidrs
-            changed = True
 
-    if changed:
-        yaml_content = yaml.safe_dump(data, default_flow_style=False)
-        return replace_if_changed(COMMON_VARS_FILE, yaml_content)
-    return False
+def run_timed(name, action, results):
+    with timed_phase(name):
+        return action(results)
 
 
-def replace_if_changed(file_path, new_content):
-    is_new_file = not os.path.exists(file_path)
+def get_critical_path(spans, dependencies):
+    if not spans:
+        return []
+    # Walk back from the last step to finish through the dependency each step waited for last
+    name = max(spans, key=lambda step: spans[step][1])
+    path = []
+    while name:
+        started, finished = spans[name]
+        path.append((name, round(finished - started, 3)))
+        finished_dependencies = [step for step in dependencies[name] if step in spans]
+        name = max(finished_dependencies, key=lambda step: spans[step][1], default=None)
+    return path[::-1]
 
-    if not is_new_file:
-        with open(file_path, "r") as f:
-            current_content = f.read()
-        has_changed = current_content != new_content
-    else:
-        has_changed = True
 
-    with open(file_path, "w") as f:
-        f.write(new_content)
+def print_critical_path():
+    path = RUN_METRICS.get("critical_path")
+    if not path:
+        return
+    total = sum(duration for _, duration in path)
+    steps = " -> ".join(f"{name} {duration:.1f}s" for name, duration in path)
+    print(f"Critical path ({total:.1f}s): {steps}")
 
-    os.chmod(file_path, 0o770)
 
-    return has_changed
+def reset_run_metrics(profile=False, trace_memory=False):
+    RUN_METRICS.clear()
+    RUN_METRICS.update(
+        {
+            "started": time.time(),
+            "phases": {},
+            "workers": 0,
+            "hosts": 0,
+            "new_hosts": 0,
+            "deferred_hosts": 0,
+            "files_written": 0,
+            "files_deleted": 0,
+            "failed_hosts": 0,
+            "hosts_targeted": 0,
+            "hosts_converged": 0,
+            "hosts_provisioned": 0,
+            "playbook_retries": 0,
+            "playbook_timed_out": 0,
+            "stalled_hosts": 0,
+            "bytes_fetched": 0,
+            "bytes_transferred": 0,
+            "success": False,
+            "profiler": cProfile.Profile() if profile or PROFILE_HOOKS else None,
+            "profile_report": profile,
+            "memory": {},
+            "peak_memory": 0,
+        }
+    )
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
 
 
-def get_cluster_data(password):
+@contextlib.contextmanager
+def timed_phase(name):
+    profiler = RUN_METRICS.get("profiler") if name in PROFILED_PHASES else None
+    tracing_memory = tracemalloc.is_tracing()
+    if tracing_memory:
+        memory_before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    update_status(phase=name)
+    started = time.perf_counter()
+    if profiler:
+        profiler.enable()
     try:
-        res = requests.post(
-            url=get_cluster_info_url(),
-            json={
-                "scaling": "scaling_up",
-                "scaling_type": SCALING_TYPE,
-                "password": password,
-                "version": VERSION,
-            },
-            timeout=REQUEST_TIMEOUT,
-        )
-    except requests.RequestException as e:
-        print(f"HTTP Request failed: {e}")
-        sys.exit(1)
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+        phases = RUN_METRICS.setdefault("phases", {})
+        phases[name] = round(phases.get(name, 0.0) + time.perf_counter() - started, 3)
+        if tracing_memory:
+            record_phase_memory(name, memory_before)
 
-    if res.status_code == 200:
-        data_json = res.json()
-        if data_json.get("VERSION") != VERSION:
-            print(
-                OUTDATED_SCRIPT_MSG.format(
-                    SCRIPT_VERSION=VERSION, LATEST_VERSION=data_json["VERSION"]
-                )
-            )
-            sys.exit(1)
-        return data_json
 
-    handle_http_errors(res)
-    return None
+def record_phase_memory(name, memory_before):
+    current, peak = tracemalloc.get_traced_memory()
+    phase_memory = RUN_METRICS.setdefault("memory", {}).setdefault(
+        name, {"allocated": 0, "peak": 0}
+    )
+    phase_memory["allocated"] += current - memory_before
+    phase_memory["peak"] = max(phase_memory["peak"], peak - memory_before)
+    RUN_METRICS["peak_memory"] = max(RUN_METRICS.get("peak_memory", 0), peak)
 
 
-def handle_http_errors(response):
-    if response.status_code == 401:
-        print(WRONG_PASSWORD_MSG)
-    elif response.status_code in [400, 405]:
-        error_msg = response.json().get("error", "An unspecified error occurred.")
-        print(error_msg)
-    else:
-        print(f"Unexpected HTTP error: {response.status_code}")
+def count_metric(name, amount=1):
+    RUN_METRICS[name] = RUN_METRICS.get(name, 0) + amount
 
-    sys.exit(1)
 
+def finish_memory_tracing():
+    if not tracemalloc.is_tracing():
+        return
+    RUN_METRICS["peak_memory"] = max(
+        RUN_METRICS.get("peak_memory", 0), tracemalloc.get_traced_memory()[1]
+    )
+    tracemalloc.stop()
+    # ru_maxrss is reported in KiB on Linux
+    RUN_METRICS["peak_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    print("\nMemory per phase (retained / peak above phase start):")
+    for name, phase_memory in RUN_METRICS["memory"].items():
+        print(
+            f"  {name:12} {format_bytes(phase_memory['allocated']):>10}  {format_bytes(phase_memory['peak']):>10}"
+        )
+    print(
+        f"Peak traced memory: {format_bytes(RUN_METRICS['peak_memory'])}, peak RSS: {format_bytes(RUN_METRICS['peak_rss'])}"
+    )
 
-def get_cluster_info_url():
-    cluster_id = socket.gethostname().split("-")[-1]
-    print(f"clsuter id {cluster_id}")
-    return CLUSTER_INFO_URL.format(cluster_id=cluster_id)
 
+def format_bytes(size):
+    for unit in ("B", "KiB", "MiB"):
+        if abs(size) < 1024:
+            return f"{size:.1f} {unit}" if unit != "B" else f"{size} B"
+        size /= 1024
+    return f"{size:.1f} GiB"
 
-def run_ansible_playbook():
-    os.chdir(PLAYBOOK_DIR)
-    forks = os.cpu_count() * 4
-    ansible_command = (
-        f"bibiplay --forks {forks} --limit '!bibigrid-worker-autoscaling-dummy'"
+
+def register_profile_hook(hook):
+    # Registering a hook enables profiling for every following run
+    PROFILE_HOOKS.append(hook)
+
+
+def finish_profiling(size=PROFILE_REPORT_SIZE):
+    profiler = RUN_METRICS.pop("profiler", None)
+    if profiler is None:
+        return None
+    stats = pstats.Stats(profiler)
+    for hook in PROFILE_HOOKS:
+        hook(stats)
+    if RUN_METRICS.get("profile_report"):
+        os.makedirs(get_context().runs_dir, exist_ok=True)
+        profile_file = os.path.join(
+            get_context().runs_dir, f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(RUN_METRICS['started']))}-profile.pstats"
+        )
+        stats.dump_stats(profile_file)
+        print(f"\nProfile of all phases except the playbook run written to {profile_file}")
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(size)
+    return stats
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Cluster Scaling Script")
+    parser.add_argument(
+        "-v", "--version", action="store_true", help="Show the version and exit"
+    )
+    parser.add_argument("-f", "--force", action="store_true", help="Force Playbook Run on all hosts (implies --reconverge)")
+    parser.add_argument(
+        "-p",
+        "--password",
+        type=str,
+        required=False,
+        help=f"Provide Password via Arg (visible in process listings, prefer ${PASSWORD_ENV_VAR}, {get_context().credentials_file} or the keyring)",
+    )
+    parser.add_argument(
+        "--save-password",
+        action="store_true",
+        help=f"Store the password in the system keyring, or in {get_context().credentials_file} without keyring support",
+    )
+    parser.add_argument(
+        "--readiness-timeout",
+        type=int,
+        default=READINESS_TIMEOUT,
+        help="Seconds to wait for new workers to become SSH-reachable and finish cloud-init",
+    )
+    parser.add_argument(
+        "--skip-readiness",
+        action="store_true",
+        help="Do not wait for new workers before running the playbook",
+    )
+    parser.add_argument(
+        "--reconverge",
+        action="store_true",
+        help="Run the playbook on all hosts, including those already provisioned with the current configuration",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=PLAYBOOK_RETRIES,
+        help="Rerun the playbook up to this many times for hosts that failed or were unreachable",
+    )
+    parser.add_argument(
+        "--playbook-timeout",
+        type=int,
+        default=PLAYBOOK_TIMEOUT,
+        help="Stop the playbook run after this many seconds (0 disables the deadline)",
     )
-    print(f"Running Ansible Command:\n{ansible_command}")
-    os.system(ansible_command)
+    parser.add_argument(
+        "--host-stall-timeout",
+        type=int,
+        default=PLAYBOOK_STALL_TIMEOUT,
+        help="Cut off a host after it stalled this many seconds in a task the other hosts finished (0 disables)",
+    )
+    parser.add_argument(
+        "--follow",
+        type=int,
+        nargs="?",
+        const=0,
+        default=None,
+        metavar="WORKERS",
+        help="Keep polling scale-data and provision new workers as soon as they are ready, "
+        "until WORKERS workers exist (or no new workers appeared for a while)",
+    )
+    parser.add_argument(
+        "--no-progress",
+        action="store_true",
+        help="Show the raw playbook output instead of the progress line on terminals",
+    )
+    parser.add_argument(
+        "--detach",
+        action="store_true",
+        help=f"Continue the run in the background, logging to {get_context().detached_log_file} (see 'status')",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Profile all phases except the playbook run and print the top functions",
+    )
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="Report peak and per-phase memory allocations of the run",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=int,
+        default=None,
+        help="Fail the run if peak traced memory exceeds this many MiB (implies --trace-memory)",
+    )
+    parser.add_argument(
+        "--metrics-dir",
+        default=PROMETHEUS_TEXTFILE_DIR,
+        help="node_exporter textfile collector directory for scaling metrics",
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    history_parser = subparsers.add_parser(
+        "history", help="Show scale-up times and the slowest recent runs"
+    )
+    history_parser.add_argument(
+        "--last",
+        type=int,
+        default=None,
+        help="Only consider the last N recorded runs",
+    )
+    status_parser = subparsers.add_parser(
+        "status", help="Show the phase, progress and ETA of the current or last run"
+    )
+    status_parser.add_argument(
+        "--follow", action="store_true", help="Follow the log of a detached run until it ends"
+    )
+    controller_parser = subparsers.add_parser(
+        "controller", help="Scale several clusters from one process, see --config"
+    )
+    controller_parser.add_argument(
+        "action", choices=["run", "status"], help="Run the controller or show the status of all clusters"
+    )
+    controller_parser.add_argument(
+        "--config", default=CONTROLLER_CONFIG_FILE, help="YAML file listing the managed clusters"
+    )
+    controller_parser.add_argument(
+        "--once", action="store_true", help="Scale every cluster once instead of polling"
+    )
+    slurm_parser = subparsers.add_parser(
+        "slurm", help="Entry points for the ResumeProgram and SuspendProgram of Slurm power saving"
+    )
+    slurm_subparsers = slurm_parser.add_subparsers(dest="slurm_command", required=True)
+    for action, help_text in (
+        ("resume", "Queue nodes to provision, called by Slurm as ResumeProgram"),
+        ("suspend", "Queue nodes that are powered down, called by Slurm as SuspendProgram"),
+    ):
+        action_parser = slurm_subparsers.add_parser(action, help=help_text)
+        action_parser.add_argument("nodes", nargs="+", help="Slurm hostlist, e.g. bibigrid-worker-1-[1-3,5]")
+    slurm_subparsers.add_parser("worker", help="Process the queued requests (started by resume and suspend)")
+    simulate_parser = slurm_subparsers.add_parser(
+        "simulate", help="Call resume or suspend the way slurmctld does, for testing"
+    )
+    simulate_parser.add_argument("action", choices=["resume", "suspend"])
+    simulate_parser.add_argument("nodes", nargs="+", help="Slurm hostlist, e.g. bibigrid-worker-1-[1-3,5]")
+    simulate_parser.add_argument(
+        "--timeout",
+        type=float,
+        default=SLURM_HOOK_TIMEOUT,
+        help="Fail if the program does not return within this many seconds",
+    )
+    simulate_parser.add_argument(
+        "--wait", action="store_true", help="Wait for the queued requests to be processed and show the result"
+    )
+    subparsers.add_parser(
+        "rollback", help="Restore the playbook files replaced by the last sync"
+    )
+    state_parser = subparsers.add_parser(
+        "state", help="Show the records of the local cluster state changed since a generation"
+    )
+    state_parser.add_argument(
+        "--since", type=int, default=0, help="Only show records changed after this generation"
+    )
+    state_parser.add_argument(
+        "--kind",
+        default=None,
+        help="Only show records of this kind (worker, volumes, group_vars, host_entries, ansible_hosts, cluster_cidrs)",
+    )
+    return parser.parse_args()
+
+
+def get_password():
+    password = getpass("Please enter your cluster password (input will be hidden): ")
+    if not password:
+        raise EmptyPasswordError("Password must not be empty!")
+    return password
+
+
+def resolve_password(password=None, interactive=True):
+    if password:
+        print("Password provided via arg..")
+        return password
+    for source, provider in (
+        (f"${PASSWORD_ENV_VAR}", get_password_from_env),
+        (get_context().credentials_file, get_password_from_file),
+        ("keyring", get_password_from_keyring),
+    ):
+        password = provider()
+        if password:
+            print(f"Password provided via {source}..")
+            return password
+    if load_session_token():
+        print("Using the cached portal session token..")
+        return None
+    if not interactive:
+        raise EmptyPasswordError(
+            f"No password found - set ${PASSWORD_ENV_VAR}, create {get_context().credentials_file} or run once with --save-password"
+        )
+    return get_password()
+
+
+def get_password_from_env():
+    return os.environ.get(PASSWORD_ENV_VAR)
+
+
+def get_password_from_file(credentials_file=None):
+    credentials_file = credentials_file or get_context().credentials_file
+    if not os.path.exists(credentials_file):
+        return None
+    check_owner_only(credentials_file)
+    with open(credentials_file, "r") as f:
+        return f.read().strip() or None
+
+
+def get_password_from_keyring():
+    try:
+        import keyring
+    except ImportError:
+        return None
+    try:
+        return keyring.get_password(KEYRING_SERVICE, get_cluster_id())
+    except Exception:
+        return None  # No usable keyring backend, e.g. in a headless session
+
+
+def store_password(password):
+    if not password:
+        return
+    try:
+        import keyring
+
+        keyring.set_password(KEYRING_SERVICE, get_cluster_id(), password)
+        print("Password stored in the system keyring.")
+        return
+    except Exception:
+        pass
+    write_owner_only(get_context().credentials_file, password + "\n")
+    print(f"Password stored in {get_context().credentials_file}.")
+
+
+def check_owner_only(file_path):
+    file_stat = os.stat(file_path)
+    if file_stat.st_uid != os.getuid() or file_stat.st_mode & 0o077:
+        raise CredentialsFileError(
+            f"{file_path} must be owned by you and not accessible by others - run: chmod 600 {file_path}"
+        )
+
+
+def write_owner_only(file_path, content):
+    os.makedirs(os.path.dirname(file_path), mode=0o700, exist_ok=True)
+    fd = os.open(file_path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(content)
+    os.replace(file_path + ".tmp", file_path)
+
+
+def load_session_token(token_file=None):
+    token_file = token_file or get_context().session_token_file
+    if not os.path.exists(token_file):
+        return None
+    try:
+        check_owner_only(token_file)
+        with open(token_file, "r") as f:
+            session = json.load(f)
+    except (ScalingError, OSError, ValueError):
+        return None
+    if session.get("expires") and session["expires"] <= time.time():
+        clear_session_token(token_file)
+        return None
+    return session.get("token")
+
+
+def save_session_token(data, token_file=None):
+    token_file = token_file or get_context().session_token_file
+    token = data.get("session_token")
+    if not token:
+        return
+    write_owner_only(
+        token_file,
+        json.dumps({"token": token, "expires": data.get("session_token_expires")}),
+    )
+
+
+def clear_session_token(token_file=None):
+    token_file = token_file or get_context().session_token_file
+    if os.path.exists(token_file):
+        os.remove(token_file)
+
+
+def update_all_yml_files(password, full_sync=False):
+    print("Initiating scaling...")
+    return sync_cluster_data(get_cluster_data(password), full_sync=full_sync)
+
+
+def sync_cluster_data(data, full_sync=False):
+    context = get_context()
+    if not data:
+        print("Failed to retrieve scaling data.")
+        return SyncResult(changed=False)
+    validate_scale_data(data)
+    worker_records = build_worker_records(data.get("workers"))
+    data = {key: value for key, value in data.items() if key != "workers"}
+    groups_vars = data.get("groups_vars", {})
+    hosts_entries = data.get("host_entries", {})
+    ansible_hosts = data.get("ansible_hosts", {})
+    cluster_cidrs = data.get("cluster_cidrs", [])
+    RUN_METRICS["workers"] = len(worker_records)
+    try:
+        store = open_state_store()
+        # The state store only commits once the playbook files are committed
+        with store:
+            changes = record_cluster_state(store, data, worker_records, full_sync=full_sync)
+            changed_fields = []
+
+            changed_hosts = needs_export(
+                changes, "ansible_hosts", file_path=context.ansible_hosts_file
+            ) and replace_ansible_hosts(ansible_hosts, changed_fields)
+            print(f"changed hosts --> {changed_hosts}")
+            changed_host_entries = needs_export(
+                changes, "host_entries", file_path=context.ansible_hosts_entries
+            ) and replace_host_entries(hosts_entries, changed_fields)
+            print(f"changed changed_host_entries --> {changed_host_entries}")
+
+            changed_groups = replace_group_vars(groups_vars, changes, changed_fields)
+            print(f"changed changed_groups --> {changed_groups}")
+
+            changed_cidrs = needs_export(
+                changes, "cluster_cidrs", file_path=context.common_vars_file
+            ) and replace_cluster_cidrs(new_cidrs=cluster_cidrs)
+            print(f"changed cidr --> {changed_cidrs}")
+
+            changed_volumes = replace_volumes_entries(worker_records, changes, changed_fields)
+            print(f"changed volumes --> {changed_volumes}")
+
+            for field in changed_fields:
+                print(f"  {field}")
+
+            commit_changeset()
+        store.close()
+    except Exception as e:
+        discard_changeset()
+        raise SyncError(f"Could not get hosts entries! ({e!r}) -- {data}") from e
+
+    return SyncResult(
+        changed=bool(
+            changed_hosts
+            or changed_host_entries
+            or changed_groups
+            or changed_cidrs
+            or changed_volumes
+        ),
+        generation=RUN_METRICS.get("generation", 0),
+        workers=RUN_METRICS["workers"],
+        changed_fields=changed_fields,
+    )
+
+
+def validate_scale_data(data):
+    problems = []
+    if not isinstance(data, dict):
+        raise PayloadValidationError([f"payload must be an object, got {type(data).__name__}"])
+
+    workers = data.get("workers")
+    if not isinstance(workers, list):
+        problems.append(f"workers must be a list, got {type(workers).__name__}")
+        workers = []
+    seen_hostnames = set()
+    for index, worker in enumerate(workers):
+        if not isinstance(worker, dict):
+            problems.append(f"workers[{index}] must be an object")
+            continue
+        hostname = worker.get("hostname")
+        if not isinstance(hostname, str) or not HOSTNAME_PATTERN.match(hostname):
+            problems.append(f"workers[{index}].hostname is not a valid hostname: {hostname!r}")
+        elif hostname in seen_hostnames:
+            problems.append(f"workers[{index}].hostname is duplicated: {hostname}")
+        else:
+            seen_hostnames.add(hostname)
+        volumes = worker.get("volumes")
+        if volumes is None:
+            continue
+        if not isinstance(volumes, list):
+            problems.append(f"workers[{index}].volumes must be a list")
+            continue
+        for volume_index, volume in enumerate(volumes):
+            if not isinstance(volume, dict):
+                problems.append(f"workers[{index}].volumes[{volume_index}] must be an object")
+
+    cluster_cidrs = data.get("cluster_cidrs", [])
+    if not isinstance(cluster_cidrs, list):
+        problems.append("cluster_cidrs must be a list")
+        cluster_cidrs = []
+    for index, cidr in enumerate(cluster_cidrs):
+        try:
+            ipaddress.ip_network(cidr, strict=False)
+        except (TypeError, ValueError):
+            problems.append(f"cluster_cidrs[{index}] is not a valid CIDR: {cidr!r}")
+
+    groups_vars = data.get("groups_vars", {})
+    if not isinstance(groups_vars, dict):
+        problems.append("groups_vars must be an object")
+        groups_vars = {}
+    for group, group_vars in groups_vars.items():
+        if not isinstance(group, str) or not GROUP_NAME_PATTERN.match(group):
+            problems.append(f"groups_vars has an invalid group name: {group!r}")
+        if not isinstance(group_vars, dict):
+            problems.append(f"groups_vars.{group} must be an object")
+
+    if not isinstance(data.get("ansible_hosts", {}), dict):
+        problems.append("ansible_hosts must be an object")
+    if not isinstance(data.get("host_entries", {}), (dict, list)):
+        problems.append("host_entries must be an object or a list")
+
+    if problems:
+        raise PayloadValidationError(problems)
+
+
+def replace_volumes_entries(worker_records, changes=None, changed_fields=None):
+    context = get_context()
+    changed = False
+
+    expected_files = set()
+
+    for hostname, worker in worker_records.items():
+        if worker.volumes_json is None:
+            continue  # Skip malformed entries
+
+        file_name = f"{hostname}.yaml"
+        file_path = os.path.join(context.host_vars_dir, file_name)
+        expected_files.add(file_name)
+        if not needs_export(changes, "volumes", hostname, file_path):
+            continue
+
+        # Serialize the volumes into YAML format
+        volumes = worker.volumes
+        yaml_data = yaml.dump({"volumes": volumes}, default_flow_style=False)
+
+        # Replace the file if content has changed
+        file_changed = replace_if_changed(
+            file_path, yaml_data, {"volumes": volumes}, changed_fields=changed_fields
+        )
+
+        if file_changed:
+            changed = True
+
+    # Remove unexpected files
+    for file in stale_files(context.host_vars_dir, expected_files, changes, "volumes"):
+        full_path = os.path.join(context.host_vars_dir, file)
+        stage_delete(full_path)
+        changed = True
+
+    return changed
+
+def replace_group_vars(groups_vars, changes=None, changed_fields=None):
+    context = get_context()
+    changed = False
+    expected_files = set()
+
+    for key, value in groups_vars.items():
+        if key == "master":
+            continue  # Do not manage master.yaml
+
+        file_name = f"{key}.yaml"
+        file_path = os.path.join(context.group_vars_dir, file_name)
+        expected_files.add(file_name)
+        if not needs_export(changes, "group_vars", key, file_path):
+            continue
+
+        yaml_data = yaml.dump(value, default_flow_style=False)
+
+        file_changed = replace_if_changed(file_path, yaml_data, value, changed_fields=changed_fields)
+        if file_changed:
+            changed = True
+
+    # Clean up unexpected files, except master.yaml
+    for file in stale_files(context.group_vars_dir, expected_files, changes, "group_vars"):
+        if file != "master.yaml":
+            full_path = os.path.join(context.group_vars_dir, file)
+            stage_delete(full_path)
+            changed = True
+
+    return changed
+
+def needs_export(changes, kind, key="", file_path=None):
+    # Without state changes (first or forced sync) every file is compared
+    if changes is None:
+        return True
+    if file_path is not None and not os.path.exists(file_path):
+        return True
+    return key in changes.get(kind, {}).get("changed", ())
+
+
+def stale_files(directory, expected_files, changes, kind):
+    if changes is None:
+        return [
+            file
+            for file in os.listdir(directory)
+            if file.endswith(".yaml") and file not in expected_files
+        ]
+    return [
+        f"{key}.yaml"
+        for key in changes.get(kind, {}).get("removed", ())
+        if f"{key}.yaml" not in expected_files
+        and os.path.exists(os.path.join(directory, f"{key}.yaml"))
+    ]
+
+
+def replace_host_entries(hosts_entries, changed_fields=None):
+    return replace_if_changed(
+        get_context().ansible_hosts_entries,
+        yaml.dump(hosts_entries, default_flow_style=False),
+        hosts_entries,
+        root_key="host_entries",
+        changed_fields=changed_fields,
+    )
+
+
+def replace_ansible_hosts(ansible_hosts, changed_fields=None):
+    return replace_if_changed(
+        get_context().ansible_hosts_file,
+        yaml.dump(ansible_hosts, default_flow_style=False),
+        ansible_hosts,
+        changed_fields=changed_fields,
+    )
+
+
+def replace_cluster_cidrs(new_cidrs: list[str]) -> bool:
+    with open(get_context().common_vars_file, "r") as f:
+        data = yaml.safe_load(f)
+
+    changed = False
+    for cluster in data.get("cluster_cidrs", []):
+        current_cidrs = cluster.get("provider_cidrs", [])
+        if normalize_for_diff(current_cidrs, "provider_cidrs") != normalize_for_diff(
+            new_cidrs, "provider_cidrs"
+        ):
+            cluster["provider_cidrs"] = new_cidrs
+            changed = True
+
+    if changed:
+        yaml_content = yaml.safe_dump(data, default_flow_style=False)
+        return replace_if_changed(get_context().common_vars_file, yaml_content)
+    return False
+
+
+def replace_if_changed(file_path, new_content, new_data=None, root_key=None, changed_fields=None):
+    is_new_file = not os.path.exists(file_path)
+
+    if not is_new_file:
+        with open(file_path, "r") as f:
+            current_content = f.read()
+        has_changed = current_content != new_content
+        if has_changed and new_data is not None:
+            fields = get_semantic_changes(current_content, new_data, root_key)
+            if not fields:
+                print(f"{file_path} differs only in ordering or ignored fields - keeping it")
+            if changed_fields is not None:
+                relative_path = os.path.relpath(file_path, get_context().playbook_dir)
+                changed_fields.extend(f"{relative_path}: {field}" for field in fields)
+            has_changed = bool(fields)
+    else:
+        has_changed = True
+    if has_changed:
+        stage_write(file_path, new_content)
+    return has_changed
+
+
+def stage_write(file_path, content):
+    PENDING_CHANGES["writes"][file_path] = content
+
+
+def stage_delete(file_path):
+    PENDING_CHANGES["deletes"].add(file_path)
+
+
+def discard_changeset():
+    PENDING_CHANGES["writes"].clear()
+    PENDING_CHANGES["deletes"].clear()
+    shutil.rmtree(get_context().staging_dir, ignore_errors=True)
+
+
+def commit_changeset():
+    writes = PENDING_CHANGES["writes"]
+    deletes = PENDING_CHANGES["deletes"]
+    if not writes and not deletes:
+        return
+    try:
+        # Nothing in the playbook tree is touched until every file is staged and synced
+        staged_files = stage_files(writes)
+        keep_previous_generation(list(writes), deletes)
+        try:
+            for staged_path, file_path in staged_files:
+                os.replace(staged_path, file_path)
+            for file_path in deletes:
+                os.remove(file_path)
+            fsync_directories([*writes, *deletes])
+        except BaseException:
+            print("Committing the playbook changes failed - restoring the previous generation")
+            rollback_generation()
+            raise
+        count_metric("files_written", len(writes))
+        count_metric("files_deleted", len(deletes))
+        print(f"Committed {len(writes)} written and {len(deletes)} deleted playbook files")
+    finally:
+        discard_changeset()
+
+
+def stage_files(writes):
+    context = get_context()
+    shutil.rmtree(context.staging_dir, ignore_errors=True)
+    os.makedirs(context.staging_dir)
+    staged_files = []
+    for index, (file_path, content) in enumerate(writes.items()):
+        staged_path = os.path.join(context.staging_dir, f"{index}-{os.path.basename(file_path)}")
+        with open(staged_path, "w") as f:
+            f.write(content)
+        os.chmod(staged_path, 0o770)
+        staged_files.append((staged_path, file_path))
+    for staged_path, _ in staged_files:
+        fsync_file(staged_path)
+    fsync_directories([context.staging_dir + os.sep])
+    return staged_files
+
+
+def keep_previous_generation(written_files, deleted_files):
+    context = get_context()
+    shutil.rmtree(context.previous_generation_dir, ignore_errors=True)
+    manifest = {}
+    for file_path in [*written_files, *deleted_files]:
+        relative_path = os.path.relpath(file_path, context.playbook_dir)
+        if not os.path.exists(file_path):
+            manifest[relative_path] = "created"
+            continue
+        previous_path = os.path.join(context.previous_generation_dir, relative_path)
+        os.makedirs(os.path.dirname(previous_path), exist_ok=True)
+        try:
+            # A hard link keeps the old inode alive after os.replace, so this costs no copy
+            os.link(file_path, previous_path)
+        except OSError:
+            shutil.copy2(file_path, previous_path)
+        manifest[relative_path] = "deleted" if file_path in deleted_files else "modified"
+
+    os.makedirs(context.previous_generation_dir, exist_ok=True)
+    manifest_path = os.path.join(context.previous_generation_dir, GENERATION_MANIFEST)
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def rollback_generation():
+    context = get_context()
+    manifest_path = os.path.join(context.previous_generation_dir, GENERATION_MANIFEST)
+    if not os.path.exists(manifest_path):
+        print("No previous generation of the playbook files to roll back to.")
+        return False
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+
+    restored_files = []
+    for relative_path, state in manifest.items():
+        file_path = os.path.join(context.playbook_dir, relative_path)
+        previous_path = os.path.join(context.previous_generation_dir, relative_path)
+        if state == "created":
+            if os.path.exists(file_path):
+                os.remove(file_path)
+        elif os.path.exists(previous_path):
+            os.replace(previous_path, file_path)
+        restored_files.append(file_path)
+    fsync_directories(restored_files)
+    shutil.rmtree(context.previous_generation_dir, ignore_errors=True)
+    print(f"Restored {len(restored_files)} playbook files from the previous generation")
+    return True
+
+
+def fsync_file(file_path):
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fsync_directories(file_paths):
+    for directory in {os.path.dirname(file_path) for file_path in file_paths}:
+        if os.path.isdir(directory):
+            fsync_file(directory)
+
+
+def open_state_store(db_file=None):
+    db_file = db_file or get_context().state_db_file
+    os.makedirs(os.path.dirname(db_file), exist_ok=True)
+    store = sqlite3.connect(db_file)
+    store.execute("PRAGMA journal_mode=WAL")
+    store.execute("PRAGMA synchronous=NORMAL")
+    store.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS records (
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            digest TEXT NOT NULL,
+            content TEXT NOT NULL,
+            generation INTEGER NOT NULL,
+            deleted INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (kind, key)
+        );
+        CREATE INDEX IF NOT EXISTS records_generation ON records (kind, generation);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS provisioned (
+            host TEXT PRIMARY KEY,
+            fingerprint TEXT NOT NULL,
+            provisioned_at REAL NOT NULL
+        );
+        """
+    )
+    return store
+
+
+def get_state_generation(store):
+    row = store.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+    return int(row[0]) if row else 0
+
+
+def get_state_record(kind, value):
+    # The content is kept as received, the digest covers its normalised form
+    content = json.dumps(value, separators=(",", ":"), default=str)
+    normalized = json.dumps(
+        normalize_for_diff(value, STATE_ROOT_KEYS.get(kind)), sort_keys=True, default=str
+    )
+    return content, hashlib.sha1(normalized.encode()).hexdigest()
+
+
+def collect_state_records(data, worker_records):
+    records = {
+        "ansible_hosts": {"": get_state_record("ansible_hosts", data.get("ansible_hosts", {}))},
+        "host_entries": {"": get_state_record("host_entries", data.get("host_entries", {}))},
+        "cluster_cidrs": {"": get_state_record("cluster_cidrs", data.get("cluster_cidrs", []))},
+        "group_vars": {
+            key: get_state_record("group_vars", value)
+            for key, value in (data.get("groups_vars") or {}).items()
+            if key != "master"
+        },
+        "worker": {},
+        "volumes": {},
+    }
+    for hostname, worker in worker_records.items():
+        records["worker"][hostname] = (worker.content, worker.digest)
+        if worker.volumes_json is not None:
+            records["volumes"][hostname] = (worker.volumes_json, worker.volumes_digest)
+    return records
+
+
+def record_cluster_state(store, data, worker_records, full_sync=False):
+    previous_generation = get_state_generation(store)
+    # After a rollback the playbook tree no longer matches the records, so every file is compared
+    if store.execute("DELETE FROM meta WHERE key = 'invalidated'").rowcount:
+        full_sync = True
+    generation = previous_generation + 1
+    existing = {
+        (kind, key): (digest, deleted)
+        for kind, key, digest, deleted in store.execute(
+            "SELECT kind, key, digest, deleted FROM records"
+        )
+    }
+
+    changes = {}
+    upserts = []
+    for kind, records in collect_state_records(data, worker_records).items():
+        kind_changes = changes.setdefault(kind, {"changed": set(), "removed": set()})
+        for key, (content, digest) in records.items():
+            if existing.pop((kind, key), None) == (digest, 0):
+                continue
+            kind_changes["changed"].add(key)
+            upserts.append((kind, key, digest, content, generation))
+
+    removals = []
+    for (kind, key), (_, deleted) in existing.items():
+        if not deleted:
+            changes.setdefault(kind, {"changed": set(), "removed": set()})["removed"].add(key)
+            removals.append((generation, kind, key))
+
+    if not upserts and not removals:
+        RUN_METRICS["generation"] = previous_generation
+        print(f"State generation {previous_generation}: no records changed")
+        return None if full_sync else changes
+
+    store.executemany(
+        "INSERT INTO records (kind, key, digest, content, generation, deleted) VALUES (?, ?, ?, ?, ?, 0) "
+        "ON CONFLICT (kind, key) DO UPDATE SET digest = excluded.digest, content = excluded.content, "
+        "generation = excluded.generation, deleted = 0",
+        upserts,
+    )
+    store.executemany(
+        "UPDATE records SET deleted = 1, generation = ? WHERE kind = ? AND key = ?", removals
+    )
+    store.execute(
+        "INSERT OR REPLACE INTO meta (key, value) VALUES ('generation', ?)", (str(generation),)
+    )
+    RUN_METRICS["generation"] = generation
+    print(
+        f"State generation {generation}: {len(upserts)} records changed, {len(removals)} removed"
+    )
+    if full_sync or previous_generation == 0:
+        return None
+    return changes
+
+
+def get_state_changes_since(store, generation, kind=None):
+    query = "SELECT kind, key, generation, deleted FROM records WHERE generation > ?"
+    parameters = [generation]
+    if kind:
+        query = "SELECT kind, key, generation, deleted FROM records WHERE kind = ? AND generation > ?"
+        parameters = [kind, generation]
+    return store.execute(query + " ORDER BY generation, kind, key", parameters).fetchall()
+
+
+def invalidate_state_store(db_file=None):
+    db_file = db_file or get_context().state_db_file
+    # Forces the next sync to compare every playbook file again
+    if not os.path.exists(db_file):
+        return
+    store = open_state_store(db_file)
+    with store:
+        store.execute("UPDATE records SET digest = ''")
+        store.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('invalidated', '1')")
+    store.close()
+
+
+def print_state_changes(since=0, kind=None):
+    if not os.path.exists(get_context().state_db_file):
+        print(f"No cluster state recorded yet ({get_context().state_db_file}).")
+        return
+    store = open_state_store()
+    print(f"Current generation: {get_state_generation(store)}")
+    for record_kind, key, generation, deleted in get_state_changes_since(store, since, kind):
+        print(f"  {generation:>6}  {record_kind:14} {key or '-'}{'  (removed)' if deleted else ''}")
+    store.close()
+
+
+def get_playbook_revision(playbook_dir=None):
+    context = get_context()
+    playbook_dir = playbook_dir or context.playbook_dir
+    # Files written by the sync are covered by the state digests, only the rest makes up the revision
+    managed_files = {
+        os.path.relpath(context.ansible_hosts_file, context.playbook_dir),
+        os.path.relpath(context.ansible_hosts_entries, context.playbook_dir),
+    }
+    revision = hashlib.sha1()
+    for root, dirs, files in os.walk(playbook_dir):
+        relative_root = os.path.relpath(root, playbook_dir)
+        dirs[:] = sorted(
+            directory
+            for directory in dirs
+            if not directory.startswith(".")
+            and os.path.join(root, directory) != context.host_vars_dir
+        )
+        for file in sorted(files):
+            relative_path = os.path.normpath(os.path.join(relative_root, file))
+            if relative_path in managed_files or file.startswith("."):
+                continue
+            if root == context.group_vars_dir and file != "master.yaml":
+                continue
+            file_stat = os.stat(os.path.join(root, file))
+            revision.update(f"{relative_path}:{file_stat.st_size}:{file_stat.st_mtime_ns}\n".encode())
+    return revision.hexdigest()
+
+
+def get_host_groups(inventory_file=None):
+    inventory_file = inventory_file or get_context().ansible_hosts_file
+    if not os.path.exists(inventory_file):
+        return {}
+    with open(inventory_file, "r") as f:
+        inventory = yaml.safe_load(f) or {}
+
+    host_groups = {}
+    for name, group in inventory.items():
+        collect_host_groups(name, group, host_groups)
+    return host_groups
+
+
+def get_master_hosts():
+    return {host for host, groups in get_host_groups().items() if MASTER_GROUP in groups}
+
+
+def collect_host_groups(name, group, host_groups, parents=()):
+    if not isinstance(group, dict):
+        return
+    lineage = (*parents, name)
+    group_hosts = group.get("hosts")
+    if isinstance(group_hosts, dict):
+        for pattern in group_hosts:
+            for host in expand_host_pattern(pattern):
+                host_groups.setdefault(host, set()).update(lineage)
+    children = group.get("children")
+    if isinstance(children, dict):
+        for child_name, child in children.items():
+            collect_host_groups(child_name, child, host_groups, lineage)
+
+
+def get_host_fingerprints(hosts):
+    # Only workers get a fingerprint, the master and unknown hosts always run the playbook
+    store = open_state_store()
+    digests = {}
+    for kind, key, digest in store.execute(
+        "SELECT kind, key, digest FROM records WHERE deleted = 0 "
+        "AND kind IN ('worker', 'volumes', 'group_vars', 'host_entries', 'ansible_hosts')"
+    ):
+        digests.setdefault(kind, {})[key] = digest
+    store.close()
+
+    revision = get_playbook_revision()
+    host_groups = get_host_groups()
+    group_digests = digests.get("group_vars", {})
+    fingerprints = {}
+    for host, host_vars in hosts.items():
+        if host not in digests.get("worker", {}):
+            continue
+        fingerprint = {
+            "revision": revision,
+            "worker": digests["worker"][host],
+            "volumes": digests.get("volumes", {}).get(host),
+            # Every worker renders /etc/hosts and inventory-derived config from the whole cluster
+            "host_entries": digests.get("host_entries", {}).get(""),
+            "ansible_hosts": digests.get("ansible_hosts", {}).get(""),
+            "host_vars": host_vars,
+            "group_vars": {
+                group: group_digests[group]
+                for group in sorted(host_groups.get(host, ()))
+                if group in group_digests
+            },
+        }
+        fingerprints[host] = hashlib.sha1(
+            json.dumps(fingerprint, sort_keys=True, default=str).encode()
+        ).hexdigest()
+    return fingerprints
+
+
+def get_converged_hosts(fingerprints):
+    store = open_state_store()
+    with store:
+        # Forget hosts that left the cluster, a new host of the same name must be provisioned again
+        store.execute("CREATE TEMP TABLE current_hosts (host TEXT PRIMARY KEY)")
+        store.executemany("INSERT INTO current_hosts VALUES (?)", ((host,) for host in fingerprints))
+        store.execute("DELETE FROM provisioned WHERE host NOT IN (SELECT host FROM current_hosts)")
+        converged_hosts = {
+            host
+            for host, fingerprint in store.execute("SELECT host, fingerprint FROM provisioned")
+            if fingerprints.get(host) == fingerprint
+        }
+    store.close()
+    return converged_hosts
+
+
+def get_provisioned_hosts(target_hosts, exit_code, timing):
+    if exit_code == 0:
+        return set(target_hosts)
+    if not timing or "stats" not in timing:
+        return set()
+    return {
+        host
+        for host, stats in timing["stats"].items()
+        if host in target_hosts and not stats.get("failures") and not stats.get("unreachable")
+    }
+
+
+def record_provisioned_hosts(fingerprints, hosts):
+    hosts = [host for host in hosts if host in fingerprints]
+    if not hosts:
+        return
+    store = open_state_store()
+    with store:
+        store.executemany(
+            "INSERT OR REPLACE INTO provisioned (host, fingerprint, provisioned_at) VALUES (?, ?, ?)",
+            ((host, fingerprints[host], time.time()) for host in hosts),
+        )
+    store.close()
+    count_metric("hosts_provisioned", len(hosts))
+    print(f"Recorded {len(hosts)} provisioned hosts")
+
+
+def forget_provisioned_hosts(hosts):
+    store = open_state_store()
+    with store:
+        store.executemany("DELETE FROM provisioned WHERE host = ?", ((host,) for host in hosts))
+    store.close()
+
+
+def load_semantic_diff_config(config_file=None):
+    config_file = config_file or get_context().semantic_diff_config_file
+    if not os.path.exists(config_file):
+        return
+    with open(config_file, "r") as f:
+        config = yaml.safe_load(f) or {}
+    ORDER_INSENSITIVE_KEYS.update(config.get("order_insensitive_keys", []))
+    IGNORED_FIELDS.update(config.get("ignored_fields", []))
+
+
+def get_semantic_changes(current_content, new_data, root_key=None):
+    try:
+        current_data = yaml.safe_load(current_content)
+    except yaml.YAMLError:
+        return ["<unparsable file>"]
+    return diff_fields(
+        normalize_for_diff(current_data, root_key), normalize_for_diff(new_data, root_key), key=root_key
+    )
+
+
+def normalize_for_diff(value, key=None):
+    if isinstance(value, dict):
+        return {
+            child_key: normalize_for_diff(child, child_key)
+            for child_key, child in value.items()
+            if child_key not in IGNORED_FIELDS
+        }
+    if isinstance(value, list):
+        items = [normalize_for_diff(item) for item in value]
+        if key in ORDER_INSENSITIVE_KEYS:
+            items.sort(key=lambda item: json.dumps(item, sort_keys=True, default=str))
+        return items
+    return value
+
+
+def diff_fields(old, new, path="", key=None):
+    if isinstance(old, dict) and isinstance(new, dict):
+        changes = []
+        for child_key in sorted(old.keys() | new.keys(), key=str):
+            child_path = f"{path}.{child_key}" if path else str(child_key)
+            if child_key not in old:
+                changes.append(f"added {child_path}")
+            elif child_key not in new:
+                changes.append(f"removed {child_path}")
+            else:
+                changes.extend(diff_fields(old[child_key], new[child_key], child_path, child_key))
+        return changes
+    if isinstance(old, list) and isinstance(new, list) and key in ORDER_INSENSITIVE_KEYS:
+        return diff_list_members(old, new, path or str(key))
+    if old != new:
+        return [f"changed {path or '<root>'}"]
+    return []
+
+
+def diff_list_members(old, new, path):
+    old_members = get_list_members(old)
+    new_members = get_list_members(new)
+    changes = []
+    for identity in sorted(old_members.keys() | new_members.keys()):
+        member_path = f"{path}[{identity}]"
+        if identity not in old_members:
+            changes.append(f"added {member_path}")
+        elif identity not in new_members:
+            changes.append(f"removed {member_path}")
+        else:
+            changes.extend(diff_fields(old_members[identity], new_members[identity], member_path))
+    return changes
+
+
+def get_list_members(items):
+    # Members are matched by name where they have one, so a changed member is not reported as replaced
+    members = {}
+    for item in items:
+        identity_key = next((key for key in LIST_MEMBER_KEYS if isinstance(item, dict) and key in item), None)
+        identity = f"{identity_key}={item[identity_key]}" if identity_key else None
+        if identity is None or identity in members:
+            return {
+                item if isinstance(item, str) else json.dumps(item, sort_keys=True, default=str): item
+                for item in items
+            }
+        members[identity] = item
+    return members
+
+
+def get_cluster_data(password):
+    request_data = {
+        "scaling": "scaling_up",
+        "scaling_type": SCALING_TYPE,
+        "password": password,
+        "version": VERSION,
+    }
+    session_token = load_session_token()
+    if session_token:
+        request_data["session_token"] = session_token
+    decoders = get_wire_decoders()
+    res = post_cluster_request(request_data, decoders)
+
+    if res.status_code == 200:
+        try:
+            data_json = decode_cluster_data(res, decoders)
+        except ValueError as e:
+            # A portal announcing a format it cannot produce correctly falls back to plain JSON
+            print(f"Could not decode {res.headers.get('Content-Type')} scale-data ({e}), retrying with JSON")
+            res = post_cluster_request(request_data, {})
+            if res.status_code != 200:
+                handle_http_errors(res)
+            data_json = decode_cluster_data(res, {})
+        if data_json.get("VERSION") != VERSION:
+            raise OutdatedScriptError(
+                OUTDATED_SCRIPT_MSG.format(
+                    SCRIPT_VERSION=VERSION, LATEST_VERSION=data_json["VERSION"]
+                )
+            )
+        save_session_token(data_json)
+        return data_json
+
+    if res.status_code == 401 and session_token:
+        clear_session_token()
+
+    handle_http_errors(res)
+    return None
+
+
+def post_cluster_request(request_data, decoders):
+    # Compressed transfer (gzip, and br/zstd where urllib3 supports them) is negotiated by requests itself
+    accept = [*decoders, "application/json;q=0.9"] if decoders else ["application/json"]
+    try:
+        res = requests.post(
+            url=get_cluster_info_url(),
+            json=request_data,
+            headers={"Accept": ", ".join(accept)},
+            timeout=REQUEST_TIMEOUT,
+        )
+    except requests.RequestException as e:
+        raise PortalRequestError(f"HTTP Request failed: {e}") from e
+
+    count_metric("bytes_fetched", len(res.content))
+    content_length = res.headers.get("Content-Length")
+    count_metric(
+        "bytes_transferred",
+        int(content_length) if content_length and content_length.isdigit() else len(res.content),
+    )
+    return res
+
+
+def get_wire_decoders():
+    # Binary encodings are only offered when their optional decoder is installed
+    decoders = {}
+    try:
+        import msgpack
+    except ImportError:
+        pass
+    else:
+        unpack = functools.partial(msgpack.unpackb, raw=False, strict_map_key=False)
+        decoders["application/msgpack"] = unpack
+        decoders["application/x-msgpack"] = unpack
+    try:
+        import cbor2
+    except ImportError:
+        pass
+    else:
+        decoders["application/cbor"] = cbor2.loads
+    return decoders
+
+
+def decode_cluster_data(response, decoders):
+    content_type = response.headers.get("Content-Type", "application/json").split(";")[0].strip().lower()
+    decoder = decoders.get(content_type)
+    started = time.perf_counter()
+    if decoder is None:
+        content_type = "application/json"
+        data = response.json()
+    else:
+        try:
+            data = decoder(response.content)
+        except Exception as e:
+            raise ValueError(str(e)) from e
+    RUN_METRICS["decode_seconds"] = round(time.perf_counter() - started, 6)
+    RUN_METRICS["wire_format"] = content_type
+    RUN_METRICS["wire_encoding"] = response.headers.get("Content-Encoding", "identity")
+    if not isinstance(data, dict):
+        raise ValueError(f"expected a mapping, got {type(data).__name__}")
+    return data
+
+
+def handle_http_errors(response):
+    if response.status_code == 401:
+        raise WrongPasswordError(WRONG_PASSWORD_MSG)
+    elif response.status_code in [400, 405]:
+        error_msg = response.json().get("error", "An unspecified error occurred.")
+        raise PortalRequestError(error_msg)
+    else:
+        raise PortalRequestError(f"Unexpected HTTP error: {response.status_code}")
+
+
+def get_cluster_info_url():
+    cluster_id = get_cluster_id()
+    print(f"clsuter id {cluster_id}")
+    return CLUSTER_INFO_URL.format(cluster_id=cluster_id)
+
+
+def get_cluster_id():
+    return get_context().cluster_id or socket.gethostname().split("-")[-1]
+
+
+def get_inventory_hosts(inventory_file=None):
+    inventory_file = inventory_file or get_context().ansible_hosts_file
+    if not os.path.exists(inventory_file):
+        return {}
+    with open(inventory_file, "r") as f:
+        inventory = yaml.safe_load(f) or {}
+
+    hosts = {}
+    collect_inventory_hosts(inventory, hosts)
+    hosts.pop(AUTOSCALING_DUMMY_HOST, None)
+    return hosts
+
+
+def collect_inventory_hosts(group, hosts):
+    if not isinstance(group, dict):
+        return
+    group_hosts = group.get("hosts")
+    if isinstance(group_hosts, dict):
+        for pattern, host_vars in group_hosts.items():
+            for host in expand_host_pattern(pattern):
+                hosts.setdefault(host, host_vars or {})
+    for key, child in group.items():
+        if key in ("hosts", "vars"):
+            continue
+        if key == "children" and isinstance(child, dict):
+            for child_group in child.values():
+                collect_inventory_hosts(child_group, hosts)
+        else:
+            collect_inventory_hosts(child, hosts)
+
+
+def expand_host_pattern(pattern):
+    # Ansible inventory ranges like "worker-[0:3]" or "worker-[00:10]"
+    match = re.search(r"\[(\d+):(\d+)\]", pattern)
+    if not match:
+        return [pattern]
+    start, end = match.group(1), match.group(2)
+    width = len(start) if start.startswith("0") and len(start) > 1 else 0
+    hosts = []
+    for number in range(int(start), int(end) + 1):
+        expanded = pattern[: match.start()] + str(number).zfill(width) + pattern[match.end():]
+        hosts.extend(expand_host_pattern(expanded))
+    return hosts
+
+
+def load_deferred_hosts():
+    if not os.path.exists(get_context().deferred_hosts_file):
+        return set()
+    with open(get_context().deferred_hosts_file, "r") as f:
+        return set(yaml.safe_load(f) or [])
+
+
+def save_deferred_hosts(hosts):
+    context = get_context()
+    if not hosts:
+        if os.path.exists(context.deferred_hosts_file):
+            os.remove(context.deferred_hosts_file)
+        return
+    os.makedirs(context.state_dir, exist_ok=True)
+    with open(context.deferred_hosts_file, "w") as f:
+        f.write(yaml.safe_dump(sorted(hosts), default_flow_style=False))
+
+
+async def wait_for_new_hosts(new_hosts, timeout=READINESS_TIMEOUT):
+    print(f"Waiting up to {timeout}s for new hosts to become ready: {sorted(new_hosts)}")
+    results = await wait_until_all_ready(new_hosts, timeout)
+    not_ready_hosts = {host for host, ready in results.items() if not ready}
+    if not_ready_hosts:
+        print(
+            f"Hosts not ready after {timeout}s - excluding them and deferring to the next run: {sorted(not_ready_hosts)}"
+        )
+    else:
+        print("All new hosts are ready.")
+    return not_ready_hosts
+
+
+async def wait_until_all_ready(new_hosts, timeout):
+    deadline = asyncio.get_running_loop().time() + timeout
+    hosts = list(new_hosts)
+    host_addresses = load_host_addresses()
+    results = await asyncio.gather(
+        *(wait_until_ready(host, new_hosts[host], deadline, host_addresses) for host in hosts)
+    )
+    return dict(zip(hosts, results))
+
+
+async def wait_until_ready(host, host_vars, deadline, host_addresses=None):
+    loop = asyncio.get_running_loop()
+    target = get_ssh_target(host, host_vars, host_addresses)
+    delay = READINESS_INITIAL_BACKOFF
+    while True:
+        if await probe_ssh_port(target) and await probe_cloud_init(target):
+            print(f"{host} is ready")
+            return True
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return False
+        await asyncio.sleep(min(delay, remaining))
+        delay = min(delay * 2, READINESS_MAX_BACKOFF)
+
+
+def load_host_addresses(entries_file=None):
+    entries_file = entries_file or get_context().ansible_hosts_entries
+    # Names of new workers only resolve once the playbook has written them to /etc/hosts
+    if not os.path.exists(entries_file):
+        return {}
+    with open(entries_file, "r") as f:
+        entries = yaml.safe_load(f) or []
+    if isinstance(entries, dict):
+        entries = [
+            {"name": name, "ip": value.get("ip") if isinstance(value, dict) else value}
+            for name, value in entries.items()
+        ]
+    return {
+        str(entry["name"]): str(entry["ip"])
+        for entry in entries
+        if isinstance(entry, dict) and entry.get("name") and entry.get("ip")
+    }
+
+
+def get_ssh_target(host, host_vars, host_addresses=None):
+    host_vars = host_vars if isinstance(host_vars, dict) else {}
+    address = host_vars.get("ansible_host") or (host_addresses or {}).get(host, host)
+    return {
+        "address": str(address),
+        "port": int(host_vars.get("ansible_port", SSH_PORT)),
+        "user": host_vars.get("ansible_user"),
+        "key_file": host_vars.get("ansible_ssh_private_key_file") or host_vars.get("ansible_private_key_file"),
+    }
+
+
+async def probe_ssh_port(target):
+    try:
+        _, writer = await asyncio.wait_for(
+            asyncio.open_connection(target["address"], target["port"]), READINESS_PROBE_TIMEOUT
+        )
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return True
+
+
+async def probe_cloud_init(target):
+    # Runs over a ControlMaster connection, so a ready host is left with a warm socket
+    return await run_ssh(target, "test", "-f", CLOUD_INIT_FINISHED_FILE)
+
+
+def ssh_command(target, *remote_command):
+    destination = f"{target['user']}@{target['address']}" if target["user"] else target["address"]
+    options = ["-p", str(target["port"])]
+    if target["key_file"]:
+        options += ["-i", os.path.expanduser(target["key_file"])]
+    return [
+        "ssh",
+        *options,
+        "-o", "BatchMode=yes",
+        "-o", f"ConnectTimeout={READINESS_PROBE_TIMEOUT}",
+        "-o", "StrictHostKeyChecking=accept-new",
+        "-o", "ControlMaster=auto",
+        "-o", f"ControlPersist={SSH_CONTROL_PERSIST}",
+        "-o", f"ControlPath={os.path.join(SSH_CONTROL_DIR, '%C')}",
+        destination,
+        *remote_command,
+    ]
+
+
+async def run_ssh(target, *remote_command):
+    os.makedirs(SSH_CONTROL_DIR, mode=0o700, exist_ok=True)
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *ssh_command(target, *remote_command),
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+    except OSError:
+        return False
+    try:
+        return await asyncio.wait_for(process.wait(), READINESS_PROBE_TIMEOUT * 2) == 0
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        return False
+
+
+async def open_control_connections(hosts):
+    host_addresses = load_host_addresses()
+    results = await asyncio.gather(
+        *(run_ssh(get_ssh_target(host, host_vars, host_addresses), "true") for host, host_vars in hosts.items())
+    )
+    failed = [host for host, opened in zip(hosts, results) if not opened]
+    if failed:
+        print(f"Could not open SSH control connections to: {sorted(failed)}")
+
+
+def get_stale_known_hosts_names(new_hosts, removed_hosts):
+    # IPs of removed workers are reused by new ones, so old keys of new hosts are dropped too
+    stale_names = set()
+    host_addresses = load_host_addresses()
+    for host, host_vars in [*new_hosts.items(), *removed_hosts.items()]:
+        target = get_ssh_target(host, host_vars, host_addresses)
+        stale_names.add(host)
+        stale_names.add(target["address"])
+        if target["port"] != SSH_PORT:
+            stale_names.add(f"[{target['address']}]:{target['port']}")
+    return stale_names
+
+
+async def scan_host_keys(hosts):
+    host_addresses = load_host_addresses()
+    addresses = {
+        (target["address"], target["port"])
+        for target in (get_ssh_target(host, host_vars, host_addresses) for host, host_vars in hosts.items())
+    }
+    results = await asyncio.gather(*(scan_host_key(address, port) for address, port in addresses))
+    return [line for lines in results for line in lines]
+
+
+async def scan_host_key(address, port=SSH_PORT):
+    try:
+        process = await asyncio.create_subprocess_exec(
+            "ssh-keyscan", "-T", str(READINESS_PROBE_TIMEOUT), "-p", str(port), address,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+    except OSError:
+        return []
+    stdout, _ = await process.communicate()
+    return [
+        line
+        for line in stdout.decode().splitlines()
+        if line.strip() and not line.startswith("#")
+    ]
+
+
+def merge_known_hosts(new_lines, stale_names, known_hosts_file=KNOWN_HOSTS_FILE):
+    known_hosts_dir = os.path.dirname(known_hosts_file)
+    os.makedirs(known_hosts_dir, mode=0o700, exist_ok=True)
+    # Runs for other clusters of the same user update the file concurrently
+    lock_fd = os.open(known_hosts_file + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+    fcntl.flock(lock_fd, fcntl.LOCK_EX)
+    try:
+        existing_lines = []
+        if os.path.exists(known_hosts_file):
+            with open(known_hosts_file, "r") as f:
+                existing_lines = f.read().splitlines()
+
+        kept_lines = [
+            line
+            for line in existing_lines
+            if not known_hosts_line_matches(line, stale_names)
+        ]
+        known_lines = set(kept_lines)
+        new_lines = [line for line in new_lines if line not in known_lines]
+        fd, tmp_path = tempfile.mkstemp(dir=known_hosts_dir, prefix=".known_hosts.")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write("\n".join(kept_lines + new_lines) + "\n")
+            os.chmod(tmp_path, 0o600)
+            os.replace(tmp_path, known_hosts_file)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    finally:
+        fcntl.flock(lock_fd, fcntl.LOCK_UN)
+        os.close(lock_fd)
+
+
+def known_hosts_line_matches(line, names):
+    fields = line.split()
+    if not fields or line.startswith("#"):
+        return False
+    host_field = fields[1] if fields[0].startswith("@") and len(fields) > 1 else fields[0]
+    for entry in host_field.split(","):
+        if entry.startswith("|1|"):
+            if any(hashed_host_matches(entry, name) for name in names):
+                return True
+            continue
+        if entry in names:
+            return True
+        if entry.startswith("[") and not entry.endswith(f"]:{SSH_PORT}"):
+            continue  # Entry for a non-default port, matched above by its "[address]:port" name
+        if entry.lstrip("[").split("]")[0] in names:
+            return True
+    return False
+
+
+def hashed_host_matches(entry, name):
+    try:
+        _, _, salt, host_hash = entry.split("|")
+        digest = hmac.new(base64.b64decode(salt), name.encode(), hashlib.sha1).digest()
+    except ValueError:
+        return False
+    return base64.b64encode(digest).decode() == host_hash
+
+
+def provision_hosts(target_hosts, excluded_hosts, fingerprints, options=None, echo=True):
+    options = options or ScalingOptions()
+    retries = options.retries
+    supervision = {
+        "timeout": options.playbook_timeout,
+        "stall_timeout": options.host_stall_timeout,
+        "progress": options.progress and echo,
+        "echo": echo,
+    }
+    # Without excluded hosts only the target hosts are named in the limit
+    if excluded_hosts is None:
+        exit_code, timing = run_ansible_playbook(limit_hosts=target_hosts, **supervision)
+    else:
+        exit_code, timing = run_ansible_playbook(excluded_hosts=excluded_hosts, **supervision)
+    timings = [timing]
+    record_provisioned_hosts(fingerprints, get_provisioned_hosts(target_hosts, exit_code, timing))
+    failed_hosts = get_failed_hosts(target_hosts, exit_code, timing)
+
+    backoff = RETRY_INITIAL_BACKOFF
+    for attempt in range(1, retries + 1):
+        if not failed_hosts:
+            break
+        print(
+            f"Retrying {len(failed_hosts)} failed hosts in {backoff}s (attempt {attempt}/{retries})..."
+        )
+        time.sleep(backoff)
+        backoff = min(backoff * 2, RETRY_MAX_BACKOFF)
+        RUN_METRICS["playbook_retries"] = attempt
+        exit_code, timing = run_ansible_playbook(limit_hosts=failed_hosts, **supervision)
+        timings.append(timing)
+        record_provisioned_hosts(fingerprints, get_provisioned_hosts(failed_hosts, exit_code, timing))
+        failed_hosts = get_failed_hosts(failed_hosts, exit_code, timing)
+
+    if failed_hosts:
+        print(f"Hosts still failing: {', '.join(sorted(failed_hosts))}")
+        update_status(last_error=f"{len(failed_hosts)} hosts still failing after {retries} retries")
+    return {"timings": timings, "failed_hosts": failed_hosts, "exit_code": exit_code}
+
+
+def get_failed_hosts(target_hosts, exit_code, timing):
+    # None when the playbook failed without reporting per-host results
+    if exit_code == 0:
+        return set()
+    if not timing or "stats" not in timing:
+        return None
+    return {
+        host
+        for host, stats in timing["stats"].items()
+        if host in target_hosts and (stats.get("failures") or stats.get("unreachable"))
+    }
+
+
+def load_failed_hosts():
+    if not os.path.exists(get_context().failed_hosts_file):
+        return set()
+    with open(get_context().failed_hosts_file, "r") as f:
+        return set(yaml.safe_load(f) or [])
+
+
+def save_failed_hosts(hosts):
+    context = get_context()
+    if not hosts:
+        if os.path.exists(context.failed_hosts_file):
+            os.remove(context.failed_hosts_file)
+        return
+    os.makedirs(context.state_dir, exist_ok=True)
+    with open(context.failed_hosts_file, "w") as f:
+        f.write(yaml.safe_dump(sorted(hosts), default_flow_style=False))
+
+
+def run_ansible_playbook(
+    excluded_hosts=(),
+    limit_hosts=None,
+    timeout=PLAYBOOK_TIMEOUT,
+    stall_timeout=PLAYBOOK_STALL_TIMEOUT,
+    progress=True,
+    echo=True,
+):
+    forks = os.cpu_count() * 4
+    task_estimates = load_task_estimates()
+    timing_file, run_environment = install_timing_callback()
+    run_prefix = timing_file[: -len("-timing.json")]
+    log_file = run_prefix + "-playbook.log"
+
+    if limit_hosts is not None:
+        limit_patterns = sorted(limit_hosts)
+    else:
+        limit_patterns = [f"!{host}" for host in [AUTOSCALING_DUMMY_HOST, *sorted(excluded_hosts)]]
+    if len(limit_patterns) > LIMIT_INLINE_HOSTS:
+        # Thousands of skipped hosts would not fit on the command line
+        limit_file = run_prefix + "-limit.txt"
+        with open(limit_file, "w") as f:
+            f.write("\n".join(limit_patterns) + "\n")
+        limit = f"@{limit_file}"
+    else:
+        limit = ":".join(limit_patterns)
+    # An argument list, inventory names from the portal never pass through a shell
+    ansible_command = ["bibiplay", "--forks", str(forks), "--limit", limit]
+
+    inventory_hosts = get_inventory_hosts().keys()
+    if limit_hosts is not None:
+        target_hosts = set(limit_hosts)
+    else:
+        target_hosts = inventory_hosts - set(excluded_hosts)
+    environment, host_vars, features = configure_acceleration(target_hosts & inventory_hosts)
+    environment.update(run_environment)
+    if host_vars:
+        # Any -i replaces the inventory of ansible.cfg, so the cluster inventory is named before the overlay
+        overlay_file = run_prefix + "-overlay.yaml"
+        with open(overlay_file, "w") as f:
+            f.write(yaml.safe_dump({"all": {"hosts": host_vars}}, default_flow_style=False))
+        ansible_command += ["-i", get_context().ansible_hosts_file, "-i", overlay_file]
+    RUN_METRICS["acceleration"] = features
+    print(f"Connection acceleration: {', '.join(features) or 'none'}")
+
+    print(f"Running Ansible Command:\n{shlex.join(ansible_command)}")
+    print(f"Full playbook output: {log_file}")
+    with playbook_slot():
+        exit_code = run_supervised(
+            ansible_command,
+            timeout,
+            stall_timeout,
+            log_file=log_file,
+            progress=PlaybookProgress(task_estimates),
+            show_progress=progress and sys.stdout.isatty(),
+            environment=environment,
+            echo=echo,
+            cwd=get_context().playbook_dir,
+            target_hosts=target_hosts & inventory_hosts,
+        )
+    if exit_code != 0:
+        print(f"Playbook failed with exit code {exit_code}")
+        update_status(last_error=f"Playbook failed with exit code {exit_code}")
+
+    timing = load_timing_file(timing_file)
+    record_acceleration_failures(log_file, features, exit_code, timing)
+    if timing and echo:
+        print_timing_report(timing)
+    return exit_code, timing
+
+
+@contextlib.contextmanager
+def playbook_slot():
+    # Set by the controller: one of a fixed number of lock files must be held to run a playbook
+    slots_dir = os.environ.get("BIBIGRID_PLAYBOOK_SLOTS_DIR")
+    if not slots_dir:
+        yield
+        return
+    slots = int(os.environ.get("BIBIGRID_PLAYBOOK_SLOTS", "1"))
+    os.makedirs(slots_dir, exist_ok=True)
+    waiting = False
+    while True:
+        for slot in range(slots):
+            fd = os.open(os.path.join(slots_dir, f"slot-{slot}.lock"), os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+            return
+        if not waiting:
+            print(f"All {slots} playbook slots are busy, waiting...")
+            update_status(phase="waiting for a playbook slot")
+            waiting = True
+        time.sleep(PLAYBOOK_SLOT_POLL_INTERVAL)
+
+
+def run_supervised(
+    command,
+    timeout=None,
+    stall_timeout=None,
+    log_file=None,
+    progress=None,
+    show_progress=False,
+    environment=None,
+    echo=True,
+    target_hosts=(),
+    cwd=None,
+):
+    environment = {**os.environ, **(environment or {})}
+    if sys.stdout.isatty() and not show_progress:
+        environment.setdefault("ANSIBLE_FORCE_COLOR", "1")
+    # A session of its own lets the deadline stop bibiplay together with all its ssh clients
+    process = subprocess.Popen(
+        command,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        errors="replace",
+        start_new_session=True,
+        cwd=cwd,
+        env=environment,
+    )
+    lines = queue.Queue()
+    threading.Thread(target=read_lines, args=(process.stdout, lines), daemon=True).start()
+    addresses = {
+        host: str(host_vars.get("ansible_host", host)) if isinstance(host_vars, dict) else host
+        for host, host_vars in get_inventory_hosts().items()
+    }
+    watchdog = PlaybookWatchdog(process, stall_timeout, addresses, target_hosts)
+    deadline = time.monotonic() + timeout if timeout else None
+    log = open(log_file, "w") if log_file else None
+    # Drawing only a status line is much cheaper than thousands of lines over a slow link
+    display = ProgressLine(show_progress)
+    try:
+        while True:
+            try:
+                line = lines.get(timeout=1)
+            except queue.Empty:
+                line = ""
+            if line is None:
+                break
+            now = time.monotonic()
+            if line:
+                if log:
+                    log.write(line)
+                watchdog.feed(line)
+                task = progress.task if progress else None
+                notable = progress.feed(line, now) if progress else True
+                if (echo and not show_progress) or notable:
+                    display.print(line.rstrip("\n"))
+                if progress and progress.task is not None and progress.task != task:
+                    update_progress_status(progress, now)
+                for host, succeeded in progress.take_host_results() if progress else ():
+                    record_host_result(host, succeeded)
+                recap = RECAP_LINE_PATTERN.match(ANSI_ESCAPE_PATTERN.sub("", line))
+                if recap:
+                    record_host_result(recap.group(1), recap.group(2) == recap.group(3) == "0")
+            for message in watchdog.check(now):
+                display.print(message)
+            if deadline and now > deadline:
+                display.print(f"Watchdog: playbook exceeded the deadline of {timeout}s, stopping it")
+                update_status(last_error=f"Playbook exceeded the deadline of {timeout}s")
+                RUN_METRICS["playbook_timed_out"] = 1
+                terminate_process_group(process)
+                break
+            if progress:
+                display.update(progress.render(now))
+        exit_code = process.wait()
+    finally:
+        display.clear()
+        if log:
+            log.close()
+    sys.stdout.flush()
+
+    if watchdog.stalled_hosts:
+        print(
+            f"Watchdog cut off {len(watchdog.stalled_hosts)} stalled hosts: "
+            f"{', '.join(sorted(watchdog.stalled_hosts))}"
+        )
+    count_metric("stalled_hosts", len(watchdog.stalled_hosts))
+    if progress and progress.slowest_task:
+        print(
+            f"Slowest task: {progress.slowest_task[0]} "
+            f"({format_duration(progress.slowest_task[1])})"
+        )
+    return exit_code
+
+
+class ProgressLine:
+    # A single terminal line rewritten in place, other output is printed above it
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.text = ""
+        self.drawn = 0.0
+
+    def print(self, line):
+        if self.enabled and self.text:
+            sys.stdout.write("\r\x1b[K")
+        sys.stdout.write(line + "\n")
+        if self.enabled and self.text:
+            self.draw()
+
+    def update(self, text):
+        if not self.enabled:
+            return
+        self.text = text
+        if time.monotonic() - self.drawn >= PROGRESS_REFRESH_INTERVAL:
+            self.draw()
+
+    def draw(self):
+        width = shutil.get_terminal_size().columns - 1
+        sys.stdout.write("\r\x1b[K" + self.text[:width])
+        sys.stdout.flush()
+        self.drawn = time.monotonic()
+
+    def clear(self):
+        if self.enabled and self.text:
+            sys.stdout.write("\r\x1b[K")
+            self.text = ""
+
+
+def update_progress_status(progress, now):
+    remaining = progress.remaining(now)
+    update_status(
+        phase=f"playbook: {progress.task}",
+        eta=time.time() + remaining if remaining is not None else RUN_STATUS.get("eta"),
+    )
+
+
+def load_task_estimates(runs=TASK_ESTIMATE_RUNS):
+    context = get_context()
+    # Median duration per task over recent runs, in the order of the most complete run
+    if not os.path.isdir(context.runs_dir):
+        return []
+    timing_files = sorted(file for file in os.listdir(context.runs_dir) if file.endswith("-timing.json"))
+    durations = {}
+    reference = []
+    for file in timing_files[-runs:]:
+        try:
+            with open(os.path.join(context.runs_dir, file), "r") as f:
+                timing = json.load(f)
+        except (OSError, ValueError):
+            continue
+        names = []
+        for task in timing.get("tasks", []):
+            duration = max((duration for duration, _ in task["hosts"].values()), default=0.0)
+            durations.setdefault(task["name"], []).append(duration)
+            names.append(task["name"])
+        if len(names) >= len(reference):
+            reference = names
+    return [(name, percentile(durations[name], 0.5)) for name in dict.fromkeys(reference)]
+
+
+def read_lines(stream, lines):
+    for line in stream:
+        lines.put(line)
+    lines.put(None)
+
+
+def terminate_process_group(process):
+    with contextlib.suppress(ProcessLookupError):
+        os.killpg(process.pid, signal.SIGTERM)
+    try:
+        process.wait(timeout=PLAYBOOK_KILL_GRACE)
+    except subprocess.TimeoutExpired:
+        with contextlib.suppress(ProcessLookupError):
+            os.killpg(process.pid, signal.SIGKILL)
+
+
+def get_descendant_pids(root_pid):
+    children = {}
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return []
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "r") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # The command name in parentheses may contain spaces
+        parent_pid = int(stat.rsplit(")", 1)[1].split()[1])
+        children.setdefault(parent_pid, []).append(int(entry))
+
+    pids = []
+    pending = [root_pid]
+    while pending:
+        for child in children.get(pending.pop(), ()):
+            pids.append(child)
+            pending.append(child)
+    return pids
+
+
+def terminate_host_connections(root_pid, address):
+    # Ansible treats the host as unreachable and carries on with the others
+    terminated = False
+    for pid in get_descendant_pids(root_pid):
+        try:
+            with open(f"/proc/{pid}/cmdline", "rb") as f:
+                arguments = f.read().split(b"\0")
+        except OSError:
+            continue
+        if os.path.basename(arguments[0]) == b"ssh" and address.encode() in arguments:
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(pid, signal.SIGTERM)
+            terminated = True
+    return terminated
+
+
+def find_ansible_config():
+    # Ansible reads only the first of these, so settings are layered through the environment instead
+    candidates = [
+        os.environ.get("ANSIBLE_CONFIG"),
+        os.path.join(get_context().playbook_dir, "ansible.cfg"),
+        os.path.join(HOME, ".ansible.cfg"),
+        "/etc/ansible/ansible.cfg",
+    ]
+    for candidate in candidates:
+        if candidate and os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+def load_ansible_config():
+    config = configparser.ConfigParser(
+        interpolation=None, strict=False, inline_comment_prefixes=(";", "#")
+    )
+    config_file = find_ansible_config()
+    if config_file:
+        try:
+            config.read(config_file)
+        except configparser.Error as e:
+            print(f"Could not parse {config_file}: {e}")
+    return config
+
+
+def get_config_flag(config, section, option):
+    try:
+        return config.getboolean(section, option, fallback=None)
+    except ValueError:
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def find_mitogen_strategy_plugins():
+    # Mitogen has to work with the Ansible bibiplay runs, which need not share this interpreter
+    interpreter = get_ansible_interpreter()
+    if not interpreter:
+        return None
+    try:
+        completed = subprocess.run(
+            [*interpreter, "-c", MITOGEN_PROBE],
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+            text=True,
+            timeout=MITOGEN_PROBE_TIMEOUT,
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    strategy_dir = completed.stdout.strip()
+    if completed.returncode != 0 or not os.path.isdir(strategy_dir):
+        return None
+    return strategy_dir
+
+
+def get_ansible_interpreter():
+    ansible_playbook = None
+    bibiplay = shutil.which("bibiplay")
+    if bibiplay:
+        try:
+            with open(bibiplay, "r", errors="replace") as f:
+                match = re.search(r"(/\S*/ansible-playbook)\b", f.read(1024 * 64))
+        except OSError:
+            match = None
+        if match and os.access(match.group(1), os.X_OK):
+            ansible_playbook = match.group(1)
+    ansible_playbook = ansible_playbook or shutil.which("ansible-playbook")
+    if not ansible_playbook:
+        return None
+    try:
+        with open(ansible_playbook, "r", errors="replace") as f:
+            shebang = f.readline()
+    except OSError:
+        return None
+    if not shebang.startswith("#!"):
+        return None
+    return tuple(shebang[2:].split())
+
+
+def load_acceleration_state():
+    if not os.path.exists(get_context().acceleration_file):
+        return {"pipelining": [], "mitogen": [], "mitogen_disabled": False}
+    with open(get_context().acceleration_file, "r") as f:
+        state = yaml.safe_load(f) or {}
+    state.setdefault("pipelining", [])
+    state.setdefault("mitogen", [])
+    state.setdefault("mitogen_disabled", False)
+    return state
+
+
+def save_acceleration_state(state):
+    os.makedirs(get_context().state_dir, exist_ok=True)
+    with open(get_context().acceleration_file, "w") as f:
+        f.write(yaml.safe_dump(state, default_flow_style=False))
+
+
+def configure_acceleration(target_hosts):
+    # Explicit settings in ansible.cfg or the environment always win over the detected defaults
+    config = load_ansible_config()
+    state = load_acceleration_state()
+    environment = {}
+    host_vars = {}
+    features = []
+
+    pipelining = get_config_flag(config, "ssh_connection", "pipelining")
+    if pipelining is None:
+        pipelining = get_config_flag(config, "defaults", "pipelining")
+    if "ANSIBLE_PIPELINING" in os.environ:
+        pipelining = os.environ["ANSIBLE_PIPELINING"].lower() in ("1", "true", "yes", "on")
+    elif pipelining is None:
+        environment["ANSIBLE_PIPELINING"] = "True"
+        pipelining = True
+    if pipelining:
+        features.append("pipelining")
+        for host in sorted(target_hosts & set(state["pipelining"])):
+            host_vars[host] = {"ansible_pipelining": False}
+
+    ssh_args = os.environ.get("ANSIBLE_SSH_ARGS")
+    if ssh_args is None:
+        ssh_args = config.get("ssh_connection", "ssh_args", fallback=None)
+        if ssh_args is None:
+            ssh_args = f"-C -o ControlMaster=auto -o ControlPersist={SSH_CONTROL_PERSIST}"
+            environment["ANSIBLE_SSH_ARGS"] = ssh_args
+    if "ControlPersist" in ssh_args:
+        features.append("persistent_connections")
+
+    # Reuse the control sockets opened for new hosts during the readiness checks
+    control_settings = {"ANSIBLE_SSH_CONTROL_PATH": "control_path", "ANSIBLE_SSH_CONTROL_PATH_DIR": "control_path_dir"}
+    if not any(
+        variable in os.environ or config.has_option("ssh_connection", option)
+        for variable, option in control_settings.items()
+    ):
+        environment["ANSIBLE_SSH_CONTROL_PATH_DIR"] = SSH_CONTROL_DIR
+        environment["ANSIBLE_SSH_CONTROL_PATH"] = "%(directory)s/%%C"
+
+    strategy = os.environ.get("ANSIBLE_STRATEGY") or config.get("defaults", "strategy", fallback=None)
+    strategy_dir = find_mitogen_strategy_plugins()
+    if strategy and strategy.startswith("mitogen"):
+        features.append("mitogen")
+    elif strategy is None and strategy_dir and not state["mitogen_disabled"]:
+        incompatible_hosts = target_hosts & set(state["mitogen"])
+        if incompatible_hosts:
+            print(f"Not using mitogen, {len(incompatible_hosts)} targeted hosts are incompatible with it")
+        else:
+            plugin_paths = [strategy_dir]
+            plugin_paths += filter(None, [os.environ.get("ANSIBLE_STRATEGY_PLUGINS")])
+            environment["ANSIBLE_STRATEGY_PLUGINS"] = ":".join(plugin_paths)
+            environment["ANSIBLE_STRATEGY"] = "mitogen_linear"
+            features.append("mitogen")
+    return environment, host_vars, features
+
+
+def record_acceleration_failures(log_file, features, exit_code, timing):
+    if exit_code == 0 or not ({"pipelining", "mitogen"} & set(features)):
+        return
+    state = load_acceleration_state()
+    changed = False
+    with open(log_file, "r", errors="replace") as f:
+        for line in f:
+            match = HOST_RESULT_PATTERN.match(ANSI_ESCAPE_PATTERN.sub("", line))
+            if not match or match.group(1) not in ("fatal", "failed", "unreachable"):
+                continue
+            host = match.group(2)
+            message = line.lower()
+            for feature, markers in (
+                ("pipelining", PIPELINING_FAILURE_MARKERS),
+                ("mitogen", MITOGEN_FAILURE_MARKERS),
+            ):
+                if feature in features and host not in state[feature] and any(
+                    marker in message for marker in markers
+                ):
+                    print(f"Disabling {feature} for {host}, it failed with it enabled")
+                    state[feature].append(host)
+                    changed = True
+    if "mitogen" in features and not (timing and timing.get("stats")):
+        # Failing before any host reported usually means mitogen does not support this Ansible
+        print("The playbook failed without host results while using mitogen, disabling mitogen")
+        state["mitogen_disabled"] = True
+        changed = True
+    if changed:
+        save_acceleration_state(state)
+
+
+def install_timing_callback():
+    context = get_context()
+    os.makedirs(context.callback_plugins_dir, exist_ok=True)
+    os.makedirs(context.runs_dir, exist_ok=True)
+    plugin_file = os.path.join(context.callback_plugins_dir, f"{TIMING_CALLBACK_NAME}.py")
+    with open(plugin_file, "w") as f:
+        f.write(TIMING_CALLBACK_PLUGIN)
+
+    plugin_paths = [context.callback_plugins_dir]
+    if os.environ.get("ANSIBLE_CALLBACK_PLUGINS"):
+        plugin_paths.append(os.environ["ANSIBLE_CALLBACK_PLUGINS"])
+    else:
+        plugin_paths += [
+            os.path.join(HOME, ".ansible", "plugins", "callback"),
+            "/usr/share/ansible/plugins/callback",
+        ]
+
+    prune_run_files("-timing.json")
+    prune_run_files("-playbook.log")
+    prune_run_files("-overlay.yaml")
+    prune_run_files("-limit.txt")
+    # Playbook runs may overlap, so every run gets its own files and environment
+    run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{time.time_ns() % 10**9:09d}"
+    timing_file = os.path.join(context.runs_dir, f"{run_id}-timing.json")
+    environment = {
+        "ANSIBLE_CALLBACK_PLUGINS": ":".join(plugin_paths),
+        "SCALING_TIMING_FILE": timing_file,
+    }
+    return timing_file, environment
+
+
+def prune_run_files(suffix):
+    run_files = sorted(file for file in os.listdir(get_context().runs_dir) if file.endswith(suffix))
+    for file in run_files[: -TIMING_FILES_KEEP + 1]:
+        os.remove(os.path.join(get_context().runs_dir, file))
+
+
+def load_timing_file(timing_file):
+    if not os.path.exists(timing_file):
+        print(f"No timing data was written by the playbook run ({timing_file}).")
+        return None
+    with open(timing_file, "r") as f:
+        return json.load(f)
+
+
+def summarize_timing(timing):
+    tasks = []
+    roles = {}
+    hosts = {}
+    for task in timing.get("tasks", []):
+        durations = [duration for duration, _ in task["hosts"].values()]
+        task_duration = max(durations, default=0.0)
+        tasks.append((task_duration, task["name"], task["role"]))
+        role = task["role"] or "-"
+        roles[role] = roles.get(role, 0.0) + task_duration
+        for host, (duration, status) in task["hosts"].items():
+            host_summary = hosts.setdefault(host, {"duration": 0.0, "failed": 0})
+            host_summary["duration"] += duration
+            if status in ("failed", "unreachable"):
+                host_summary["failed"] += 1
+    return {
+        "tasks": sorted(tasks, reverse=True),
+        "roles": sorted(roles.items(), key=lambda item: item[1], reverse=True),
+        "hosts": sorted(hosts.items(), key=lambda item: item[1]["duration"], reverse=True),
+    }
+
+
+def print_timing_report(timing, size=TIMING_REPORT_SIZE):
+    summary = summarize_timing(timing)
+    print(f"\nPlaybook finished in {timing.get('duration', 0.0):.1f}s")
+    print("Slowest tasks:")
+    for duration, name, role in summary["tasks"][:size]:
+        print(f"  {duration:8.1f}s  {f'{role} : ' if role else ''}{name}")
+    print("Slowest roles:")
+    for role, duration in summary["roles"][:size]:
+        print(f"  {duration:8.1f}s  {role}")
+    print("Slowest hosts:")
+    for host, host_summary in summary["hosts"][:size]:
+        failed = f"  ({host_summary['failed']} failed)" if host_summary["failed"] else ""
+        print(f"  {host_summary['duration']:8.1f}s  {host}{failed}")
+
+
+def record_run_history():
+    phases = RUN_METRICS.get("phases", {})
+    entry = {
+        "timestamp": round(RUN_METRICS["started"], 3),
+        "version": VERSION,
+        "workers": RUN_METRICS.get("workers", 0),
+        "hosts": RUN_METRICS.get("hosts", 0),
+        "hosts_targeted": RUN_METRICS.get("hosts_targeted", 0),
+        "new_hosts": RUN_METRICS.get("new_hosts", 0),
+        "changeset": RUN_METRICS.get("files_written", 0) + RUN_METRICS.get("files_deleted", 0),
+        "phases": phases,
+        "playbook_duration": phases.get("playbook") if "playbook_exit_code" in RUN_METRICS else None,
+        "total_duration": round(time.time() - RUN_METRICS["started"], 3),
+        "failed_hosts": RUN_METRICS.get("failed_hosts", 0),
+        "deferred_hosts": RUN_METRICS.get("deferred_hosts", 0),
+        "converged_hosts": RUN_METRICS.get("hosts_converged", 0),
+        "playbook_retries": RUN_METRICS.get("playbook_retries", 0),
+        "stalled_hosts": RUN_METRICS.get("stalled_hosts", 0),
+        "acceleration": RUN_METRICS.get("acceleration", []),
+        "first_worker_seconds": RUN_METRICS.get("first_worker_seconds"),
+        "success": RUN_METRICS.get("success", False),
+        "critical_path": [name for name, _ in RUN_METRICS.get("critical_path", [])],
+    }
+    if RUN_METRICS.get("peak_memory"):
+        entry["peak_memory"] = RUN_METRICS["peak_memory"]
+        entry["peak_rss"] = RUN_METRICS.get("peak_rss")
+    os.makedirs(get_context().state_dir, exist_ok=True)
+    with open(get_context().history_file, "a") as f:
+        f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+
+def load_run_history(last=None):
+    if not os.path.exists(get_context().history_file):
+        return []
+    entries = []
+    with open(get_context().history_file, "r") as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue  # Skip lines of an interrupted write
+    return entries[-last:] if last else entries
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def cluster_size_bucket(workers):
+    bucket = 1
+    while bucket < workers:
+        bucket *= 4
+    return bucket
+
+
+def print_history(last=None, size=HISTORY_REPORT_SIZE):
+    entries = load_run_history(last)
+    if not entries:
+        print(f"No scaling runs recorded yet ({get_context().history_file}).")
+        return
+
+    playbook_runs = [entry for entry in entries if entry.get("playbook_duration") is not None]
+    print(f"{len(entries)} runs recorded, {len(playbook_runs)} with a playbook run")
+
+    buckets = {}
+    for entry in playbook_runs:
+        buckets.setdefault(cluster_size_bucket(entry["workers"]), []).append(entry)
+    print("\nScale-up time by cluster size:")
+    print(f"  {'workers':>10}  {'runs':>5}  {'p50':>9}  {'p95':>9}  {'playbook p50':>13}")
+    for bucket, bucket_entries in sorted(buckets.items()):
+        totals = [entry["total_duration"] for entry in bucket_entries]
+        playbooks = [entry["playbook_duration"] for entry in bucket_entries]
+        print(
+            f"  {'<= ' + str(bucket):>10}  {len(bucket_entries):>5}  "
+            f"{percentile(totals, 0.5):>8.1f}s  {percentile(totals, 0.95):>8.1f}s  "
+            f"{percentile(playbooks, 0.5):>12.1f}s"
+        )
+
+    print("\nSlowest recent runs:")
+    slowest = sorted(entries, key=lambda entry: entry["total_duration"], reverse=True)
+    for entry in slowest[:size]:
+        started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["timestamp"]))
+        phases = ", ".join(
+            f"{name} {duration:.1f}s" for name, duration in entry.get("phases", {}).items()
+        )
+        print(
+            f"  {started}  v{entry['version']}  {entry['total_duration']:8.1f}s  "
+            f"workers={entry['workers']} changeset={entry['changeset']} "
+            f"failed_hosts={entry['failed_hosts']} "
+            f"acceleration={','.join(entry.get('acceleration', [])) or '-'}  [{phases}]"
+        )
+
+
+def save_last_success():
+    os.makedirs(get_context().state_dir, exist_ok=True)
+    with open(get_context().last_success_file, "w") as f:
+        f.write(f"{time.time():.3f}\n")
+
+
+def load_last_success(last_success_file=None):
+    last_success_file = last_success_file or get_context().last_success_file
+    try:
+        with open(last_success_file, "r") as f:
+            return float(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def format_prometheus_metrics():
+    metrics = [
+        ("run_timestamp_seconds", "gauge", "Start time of the last scaling run.", [({}, RUN_METRICS["started"])]),
+        ("run_duration_seconds", "gauge", "Duration of the last scaling run.", [({}, time.time() - RUN_METRICS["started"])]),
+        ("run_success", "gauge", "Whether the last scaling run succeeded.", [({}, int(RUN_METRICS.get("success", False)))]),
+        (
+            "phase_duration_seconds",
+            "gauge",
+            "Duration of each phase of the last scaling run.",
+            [({"phase": name}, duration) for name, duration in sorted(RUN_METRICS.get("phases", {}).items())],
+        ),
+        ("portal_bytes_fetched", "gauge", "Bytes of scale-data fetched from the portal.", [({}, RUN_METRICS.get("bytes_fetched", 0))]),
+        ("portal_bytes_transferred", "gauge", "Bytes of scale-data on the wire, before decompression.", [({}, RUN_METRICS.get("bytes_transferred", 0))]),
+        ("files_written", "gauge", "Playbook files written with changed content.", [({}, RUN_METRICS.get("files_written", 0))]),
+        ("files_deleted", "gauge", "Playbook files deleted.", [({}, RUN_METRICS.get("files_deleted", 0))]),
+        ("workers", "gauge", "Workers reported by the portal.", [({}, RUN_METRICS.get("workers", 0))]),
+        ("hosts_targeted", "gauge", "Hosts targeted by the playbook run.", [({}, RUN_METRICS.get("hosts_targeted", 0))]),
+        ("hosts_converged", "gauge", "Hosts skipped because they are provisioned with the current configuration.", [({}, RUN_METRICS.get("hosts_converged", 0))]),
+        ("hosts_provisioned", "gauge", "Hosts recorded as provisioned by the playbook run.", [({}, RUN_METRICS.get("hosts_provisioned", 0))]),
+        ("hosts_deferred", "gauge", "New hosts deferred because they were not ready.", [({}, RUN_METRICS.get("deferred_hosts", 0))]),
+        ("hosts_failed", "gauge", "Hosts with failed or unreachable tasks.", [({}, RUN_METRICS.get("failed_hosts", 0))]),
+        ("hosts_stalled", "gauge", "Hosts cut off by the watchdog after stalling in a task.", [({}, RUN_METRICS.get("stalled_hosts", 0))]),
+        ("playbook_timed_out", "gauge", "Whether the playbook run was stopped at its deadline.", [({}, RUN_METRICS.get("playbook_timed_out", 0))]),
+        ("playbook_retries", "gauge", "Playbook reruns for failed hosts.", [({}, RUN_METRICS.get("playbook_retries", 0))]),
+    ]
+    if "acceleration" in RUN_METRICS:
+        metrics.append(
+            (
+                "acceleration_enabled",
+                "gauge",
+                "Connection acceleration used by the last playbook run.",
+                [({"feature": feature}, int(feature in RUN_METRICS["acceleration"])) for feature in ACCELERATION_FEATURES],
+            )
+        )
+    if "first_worker_seconds" in RUN_METRICS:
+        metrics.append(
+            ("first_worker_seconds", "gauge", "Time until the first new worker was provisioned in follow mode.", [({}, RUN_METRICS["first_worker_seconds"])])
+        )
+    if "wire_format" in RUN_METRICS:
+        metrics.append(
+            (
+                "portal_decode_seconds",
+                "gauge",
+                "Time spent decoding the scale-data.",
+                [({"format": RUN_METRICS["wire_format"], "encoding": RUN_METRICS["wire_encoding"]}, RUN_METRICS["decode_seconds"])],
+            )
+        )
+    if "playbook_exit_code" in RUN_METRICS:
+        metrics.append(
+            ("playbook_exit_code", "gauge", "Exit code of the last playbook run.", [({}, RUN_METRICS["playbook_exit_code"])])
+        )
+    if RUN_METRICS.get("peak_memory"):
+        metrics.append(
+            ("peak_memory_bytes", "gauge", "Peak traced Python memory of the last scaling run.", [({}, RUN_METRICS["peak_memory"])])
+        )
+        metrics.append(
+            (
+                "phase_peak_memory_bytes",
+                "gauge",
+                "Peak traced memory above the start of each phase.",
+                [({"phase": name}, phase_memory["peak"]) for name, phase_memory in sorted(RUN_METRICS["memory"].items())],
+            )
+        )
+    last_success = load_last_success()
+    if last_success is not None:
+        # Use time() - bibigrid_scaling_last_success_timestamp_seconds for the time since the last sync
+        metrics.append(
+            ("last_success_timestamp_seconds", "gauge", "Time of the last successful scaling run.", [({}, last_success)])
+        )
+
+    lines = []
+    for name, metric_type, help_text, samples in metrics:
+        full_name = f"bibigrid_scaling_{name}"
+        lines.append(f"# HELP {full_name} {help_text}")
+        lines.append(f"# TYPE {full_name} {metric_type}")
+        for labels, value in samples:
+            if get_context().cluster_name:
+                labels = {"cluster": get_context().cluster_name, **labels}
+            label_text = ",".join(f'{key}="{value}"' for key, value in labels.items())
+            lines.append(f"{full_name}{{{label_text}}} {value}" if label_text else f"{full_name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus_metrics(metrics_dir=PROMETHEUS_TEXTFILE_DIR):
+    if not metrics_dir or not os.path.isdir(metrics_dir):
+        return
+    metrics_file = os.path.join(metrics_dir, get_context().prometheus_metrics_file)
+    try:
+        # The collector only reads *.prom files, so the temp file is never scraped half-written
+        fd, tmp_path = tempfile.mkstemp(dir=metrics_dir, prefix=f".{get_context().prometheus_metrics_file}.", suffix=".tmp")
+    except OSError as e:
+        print(f"Could not write scaling metrics to {metrics_dir}: {e}")
+        return
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(format_prometheus_metrics())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, metrics_file)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def reset_run_status(log_file=None):
+    with get_context().status_lock:
+        RUN_STATUS.clear()
+        RUN_STATUS.update(
+            {
+                "pid": os.getpid(),
+                "state": "running",
+                "phase": "starting",
+                "started": time.time(),
+                "hosts_total": 0,
+                "hosts_done": 0,
+                "hosts_failed": 0,
+                "eta": None,
+                "last_error": None,
+                "log_file": log_file,
+                "hosts": {},
+            }
+        )
+        write_status()
+
+
+def update_status(**fields):
+    # Outside of scale() there is no run to report on
+    with get_context().status_lock:
+        if not RUN_STATUS:
+            return
+        RUN_STATUS.update(fields)
+        write_status()
+
+
+def record_host_result(host, succeeded):
+    with get_context().status_lock:
+        if not RUN_STATUS:
+            return
+        # A host retried successfully counts as done
+        RUN_STATUS["hosts"][host] = succeeded
+        RUN_STATUS["hosts_done"] = sum(RUN_STATUS["hosts"].values())
+        RUN_STATUS["hosts_failed"] = len(RUN_STATUS["hosts"]) - RUN_STATUS["hosts_done"]
+        write_status()
+
+
+def write_status(status_file=None):
+    status_file = status_file or get_context().status_file
+    status = {key: value for key, value in RUN_STATUS.items() if key != "hosts"}
+    status["updated"] = time.time()
+    os.makedirs(os.path.dirname(status_file), exist_ok=True)
+    tmp_file = status_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(status, f)
+    os.replace(tmp_file, status_file)
+
+
+def load_status(status_file=None):
+    status_file = status_file or get_context().status_file
+    try:
+        with open(status_file, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def check_no_run_in_progress():
+    status = load_status()
+    if not status or status["state"] != "running" or status["pid"] == os.getpid():
+        return
+    if process_alive(status["pid"]):
+        raise ScalingInProgressError(
+            f"A scaling run is already in progress (pid {status['pid']}, phase {status['phase']}). "
+            "Check on it with 'scaling.py status'."
+        )
+
+
+def estimate_playbook_eta(hosts):
+    durations = [
+        entry["playbook_duration"]
+        for entry in load_run_history()
+        if entry.get("playbook_duration") is not None
+        and cluster_size_bucket(entry.get("hosts_targeted") or entry["workers"])
+        == cluster_size_bucket(hosts)
+    ]
+    if not durations:
+        return None
+    return time.time() + percentile(durations, 0.5)
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m {seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+def print_status(status_file=None):
+    status_file = status_file or get_context().status_file
+    status = load_status(status_file)
+    if not status:
+        print(f"No scaling run recorded yet ({status_file}).")
+        return
+    state = status["state"]
+    if state == "running" and not process_alive(status["pid"]):
+        state = "aborted"
+    now = time.time()
+    started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(status["started"]))
+    print(f"State:      {state} (pid {status['pid']})")
+    print(f"Phase:      {status['phase']}")
+    print(f"Started:    {started} ({format_duration(now - status['started'])} ago)")
+    if status["hosts_total"]:
+        print(
+            f"Hosts:      {status['hosts_done']}/{status['hosts_total']} done, "
+            f"{status['hosts_failed']} failed"
+        )
+    if state == "running" and status["eta"]:
+        eta = time.strftime("%H:%M:%S", time.localtime(status["eta"]))
+        remaining = format_duration(status["eta"] - now) if status["eta"] > now else "overdue"
+        print(f"ETA:        {eta} ({remaining})")
+    if status["last_error"]:
+        print(f"Last error: {status['last_error']}")
+    if status["log_file"]:
+        print(f"Log:        {status['log_file']}")
+
+
+def follow_log(status_file=None):
+    status_file = status_file or get_context().status_file
+    status = load_status(status_file)
+    if not status or not status["log_file"] or not os.path.exists(status["log_file"]):
+        print("The last run was not detached, there is no log to follow.")
+        return
+    print()
+    with open(status["log_file"], "r") as f, contextlib.suppress(KeyboardInterrupt):
+        while True:
+            line = f.readline()
+            if line:
+                sys.stdout.write(line)
+                continue
+            status = load_status(status_file)
+            if not status or status["state"] != "running" or not process_alive(status["pid"]):
+                sys.stdout.write(f.read())
+                break
+            time.sleep(STATUS_FOLLOW_INTERVAL)
+
+
+def detach(log_file=None):
+    log_file = log_file or get_context().detached_log_file
+    os.makedirs(os.path.dirname(log_file), exist_ok=True)
+    if os.path.exists(log_file):
+        os.replace(log_file, log_file + ".1")
+    sys.stdout.flush()
+    sys.stderr.flush()
+    if os.fork() > 0:
+        print(f"Scaling continues in the background, logging to {log_file}")
+        print(f"Check on it with: {sys.argv[0]} status [--follow]")
+        sys.exit(0)
+    # A new session without a controlling terminal survives the SSH connection
+    os.setsid()
+    if os.fork() > 0:
+        os._exit(0)
+    null_fd = os.open(os.devnull, os.O_RDONLY)
+    log_fd = os.open(log_file, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+    os.dup2(null_fd, 0)
+    os.dup2(log_fd, 1)
+    os.dup2(log_fd, 2)
+    os.close(null_fd)
+    os.close(log_fd)
+    sys.stdout.reconfigure(line_buffering=True)
+    sys.stderr.reconfigure(line_buffering=True)
+
+
+def load_controller_config(config_file=CONTROLLER_CONFIG_FILE):
+    if not os.path.exists(config_file):
+        raise ControllerConfigError(f"No controller configuration found at {config_file}")
+    with open(config_file, "r") as f:
+        try:
+            config = yaml.safe_load(f) or {}
+        except yaml.YAMLError as e:
+            raise ControllerConfigError(f"Could not parse {config_file}: {e}") from e
+
+    problems = []
+    clusters = config.get("clusters")
+    if not isinstance(clusters, list) or not clusters:
+        problems.append("clusters: expected a non-empty list")
+        clusters = []
+    names = set()
+    for index, cluster in enumerate(clusters):
+        if not isinstance(cluster, dict):
+            problems.append(f"clusters[{index}]: expected a mapping")
+            continue
+        name = cluster.get("name")
+        if not isinstance(name, str) or not GROUP_NAME_PATTERN.match(name):
+            problems.append(f"clusters[{index}].name: expected a name of letters, digits, '_', '.' or '-'")
+        elif name in names:
+            problems.append(f"clusters[{index}].name: duplicate name {name!r}")
+        names.add(name)
+        if not cluster.get("cluster_id"):
+            problems.append(f"clusters[{index}].cluster_id: missing")
+        if not os.path.isdir(str(cluster.get("playbook_dir"))):
+            problems.append(f"clusters[{index}].playbook_dir: not a directory: {cluster.get('playbook_dir')}")
+        if cluster.get("password_file"):
+            try:
+                if not get_password_from_file(cluster["password_file"]):
+                    problems.append(f"clusters[{index}].password_file: missing or empty: {cluster['password_file']}")
+            except (ScalingError, OSError) as e:
+                problems.append(f"clusters[{index}].password_file: {e}")
+        cluster.setdefault("state_dir", os.path.join(CONTROLLER_CLUSTERS_DIR, str(name)))
+        cluster.setdefault("interval", config.get("interval", CONTROLLER_INTERVAL))
+        cluster.setdefault("args", [])
+    if problems:
+        raise ControllerConfigError(f"Invalid controller configuration {config_file}:\n  " + "\n  ".join(problems))
+    config.setdefault("max_playbooks", CONTROLLER_MAX_PLAYBOOKS)
+    config.setdefault("metrics_dir", PROMETHEUS_TEXTFILE_DIR)
+    return config
+
+
+def get_cluster_environment(cluster, config):
+    environment = {
+        **os.environ,
+        "BIBIGRID_CLUSTER_NAME": cluster["name"],
+        "BIBIGRID_CLUSTER_ID": str(cluster["cluster_id"]),
+        "BIBIGRID_PLAYBOOK_DIR": cluster["playbook_dir"],
+        "BIBIGRID_SCALING_STATE_DIR": cluster["state_dir"],
+        "BIBIGRID_PLAYBOOK_SLOTS_DIR": CONTROLLER_SLOTS_DIR,
+        "BIBIGRID_PLAYBOOK_SLOTS": str(config["max_playbooks"]),
+    }
+    # Without a configured password the run falls back to the credentials file or keyring of the cluster
+    environment.pop(PASSWORD_ENV_VAR, None)
+    if cluster.get("password_file"):
+        password = get_password_from_file(cluster["password_file"])
+        if not password:
+            raise ControllerConfigError(f"The password file of {cluster['name']} is missing or empty")
+        environment[PASSWORD_ENV_VAR] = password
+    elif cluster.get("password_env"):
+        environment[PASSWORD_ENV_VAR] = os.environ.get(cluster["password_env"], "")
+    return environment
+
+
+async def run_controller(config, once=False):
+    print(
+        f"Managing {len(config['clusters'])} clusters with at most "
+        f"{config['max_playbooks']} concurrent playbook runs"
+    )
+    results = await asyncio.gather(
+        *(run_cluster_loop(cluster, config, once) for cluster in config["clusters"])
+    )
+    return dict(zip((cluster["name"] for cluster in config["clusters"]), results))
+
+
+async def run_cluster_loop(cluster, config, once=False):
+    while True:
+        started = time.monotonic()
+        # A cluster that cannot be scaled must not stop the loops of the others
+        try:
+            exit_code = await run_cluster(cluster, config)
+            print(f"[{cluster['name']}] scaling run finished with exit code {exit_code}")
+        except Exception as e:
+            exit_code = None
+            print(f"[{cluster['name']}] scaling run could not be started: {e!r}")
+        if once:
+            return exit_code
+        await asyncio.sleep(max(0.0, cluster["interval"] - (time.monotonic() - started)))
+
+
+async def run_cluster(cluster, config):
+    # Every cluster runs in a process of its own, so the module state of one run never mixes with another
+    os.makedirs(cluster["state_dir"], exist_ok=True)
+    command = [
+        sys.executable,
+        os.path.abspath(__file__),
+        "--no-progress",
+        "--metrics-dir",
+        config["metrics_dir"],
+        *map(str, cluster["args"]),
+    ]
+    log_file = os.path.join(cluster["state_dir"], "controller.log")
+    with open(log_file, "a") as log:
+        log.write(f"--- {time.strftime('%Y-%m-%d %H:%M:%S')} {' '.join(command)}\n")
+        log.flush()
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=log,
+            stderr=asyncio.subprocess.STDOUT,
+            env=get_cluster_environment(cluster, config),
+            cwd=cluster["state_dir"],
+        )
+        return await process.wait()
+
+
+def print_controller_status(config):
+    now = time.time()
+    print(f"{'cluster':20} {'state':9} {'phase':28} {'hosts':>11}  {'eta':>9}  {'last success':>16}  last error")
+    for cluster in config["clusters"]:
+        context = ScalingContext(cluster["playbook_dir"], cluster["state_dir"], cluster["name"])
+        status = load_status(context.status_file) or {}
+        state = status.get("state", "-")
+        if state == "running" and not process_alive(status["pid"]):
+            state = "aborted"
+        hosts = f"{status['hosts_done']}/{status['hosts_total']}" if status.get("hosts_total") else "-"
+        eta = "-"
+        if state == "running" and status.get("eta"):
+            eta = format_duration(status["eta"] - now) if status["eta"] > now else "overdue"
+        last_success = load_last_success(context.last_success_file)
+        last_success_text = (
+            time.strftime("%Y-%m-%d %H:%M", time.localtime(last_success)) if last_success else "-"
+        )
+        print(
+            f"{cluster['name'][:20]:20} {state:9} {str(status.get('phase', '-'))[:28]:28} {hosts:>11}  "
+            f"{eta:>9}  {last_success_text:>16}  {status.get('last_error') or ''}"
+        )
+
+
+def expand_hostlist(expression):
+    # Slurm hostlists like "bibigrid-worker-1-[1-3,07-08],bibigrid-worker-2-1"
+    names = []
+    depth = 0
+    start = 0
+    for index, char in enumerate(expression + ","):
+        if char == "[":
+            depth += 1
+        elif char == "]":
+            depth -= 1
+        elif char == "," and depth == 0:
+            if expression[start:index]:
+                names.extend(expand_hostlist_name(expression[start:index]))
+            start = index + 1
+        if depth not in (0, 1):
+            raise HostlistError(f"Invalid hostlist: {expression}")
+    if depth:
+        raise HostlistError(f"Invalid hostlist: {expression}")
+    return list(dict.fromkeys(names))
+
+
+def expand_hostlist_name(name):
+    match = re.search(r"\[([^\]]*)\]", name)
+    if not match:
+        if not HOSTNAME_PATTERN.match(name):
+            raise HostlistError(f"Invalid node name: {name}")
+        return [name]
+    names = []
+    for part in match.group(1).split(","):
+        range_match = HOSTLIST_RANGE_PATTERN.match(part)
+        if not range_match:
+            raise HostlistError(f"Invalid range [{match.group(1)}] in {name}")
+        first, last = range_match.group(1), range_match.group(2) or range_match.group(1)
+        for number in range(int(first), int(last) + 1):
+            expanded = name[: match.start()] + str(number).zfill(len(first)) + name[match.end():]
+            names.extend(expand_hostlist_name(expanded))
+    return names
+
+
+@contextlib.contextmanager
+def slurm_queue():
+    context = get_context()
+    os.makedirs(context.state_dir, exist_ok=True)
+    lock_fd = os.open(context.slurm_queue_file + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+    fcntl.flock(lock_fd, fcntl.LOCK_EX)
+    try:
+        queue = {"resume": {}, "suspend": {}}
+        if os.path.exists(context.slurm_queue_file):
+            with open(context.slurm_queue_file, "r") as f:
+                queue.update(json.load(f))
+        yield queue
+        tmp_file = context.slurm_queue_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(queue, f)
+        os.replace(tmp_file, context.slurm_queue_file)
+    finally:
+        fcntl.flock(lock_fd, fcntl.LOCK_UN)
+        os.close(lock_fd)
+
+
+def check_slurm_setup():
+    context = get_context()
+    # slurmctld runs the hooks as SlurmUser, whose home has neither the playbook nor the scaling state
+    problems = []
+    if not os.path.isfile(context.common_vars_file):
+        problems.append(f"{context.common_vars_file} not found")
+    try:
+        os.makedirs(context.state_dir, exist_ok=True)
+    except OSError as e:
+        problems.append(f"cannot create {context.state_dir}: {e.strerror}")
+    else:
+        if not os.access(context.state_dir, os.W_OK):
+            problems.append(f"{context.state_dir} is not writable")
+    if problems:
+        raise SlurmSetupError(
+            f"Running with HOME={HOME}: {'; '.join(problems)}.\n"
+            "Slurm runs ResumeProgram and SuspendProgram as SlurmUser. Call this script from a wrapper "
+            "that switches to the cluster user, e.g. 'exec sudo -n -H -u ubuntu python3 /home/ubuntu/scaling.py "
+            "slurm resume \"$@\"', or set BIBIGRID_PLAYBOOK_DIR and BIBIGRID_SCALING_STATE_DIR."
+        )
+
+
+def queue_slurm_request(action, nodes, metrics_dir=PROMETHEUS_TEXTFILE_DIR):
+    # Returns right away, slurmctld does not wait for the nodes anyway
+    other_action = "suspend" if action == "resume" else "resume"
+    now = time.time()
+    with slurm_queue() as queue:
+        for node in nodes:
+            # A later request for the same node replaces the earlier one
+            queue[other_action].pop(node, None)
+            queue[action].setdefault(node, now)
+    print(f"Queued {action} of {len(nodes)} nodes: {', '.join(nodes)}")
+    start_slurm_worker(metrics_dir)
+
+
+def start_slurm_worker(metrics_dir=PROMETHEUS_TEXTFILE_DIR):
+    # A worker already holding the lock picks the new requests up and this one exits again
+    with open(get_context().slurm_log_file, "a") as log:
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--metrics-dir", metrics_dir, "slurm", "worker"],
+            stdin=subprocess.DEVNULL,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
+
+
+def run_slurm_worker(metrics_dir=PROMETHEUS_TEXTFILE_DIR):
+    # The worker lock only changes hands under the queue lock, see simulate_slurm_call()
+    with slurm_queue():
+        lock_fd = os.open(get_context().slurm_worker_lock_file, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(lock_fd)
+            return
+    try:
+        while True:
+            # Requests arriving within the window are provisioned in one playbook run
+            time.sleep(SLURM_COALESCE_WINDOW)
+            try:
+                check_no_run_in_progress()
+            except ScalingInProgressError as e:
+                print(f"{e} Waiting for it to finish...")
+                continue
+            with slurm_queue() as queue:
+                resume, suspend = queue["resume"], queue["suspend"]
+                if not resume and not suspend:
+                    # Released under the queue lock, so a request queued now starts a new worker
+                    os.close(lock_fd)
+                    lock_fd = None
+                    return
+                queue["resume"], queue["suspend"] = {}, {}
+            process_slurm_batch(resume, suspend, metrics_dir)
+    finally:
+        if lock_fd is not None:
+            os.close(lock_fd)
+
+
+def process_slurm_batch(resume, suspend, metrics_dir=PROMETHEUS_TEXTFILE_DIR):
+    print(
+        f"--- {time.strftime('%Y-%m-%d %H:%M:%S')} resume: {', '.join(sorted(resume)) or '-'} "
+        f"suspend: {', '.join(sorted(suspend)) or '-'}"
+    )
+    options = ScalingOptions(
+        # Slurm requeues the jobs of nodes marked down, a retry would only risk the ResumeTimeout
+        retries=0,
+        progress=False,
+        resume=frozenset(resume),
+        suspend=frozenset(suspend),
+        resume_deadline=min(resume.values(), default=time.time())
+        + get_slurm_resume_timeout()
+        - SLURM_RESUME_MARGIN,
+    )
+    down_nodes = set(resume)
+    try:
+        password = resolve_password(interactive=False)
+        result = scale(password, options, metrics_dir=metrics_dir, log_file=get_context().slurm_log_file)
+        down_nodes = (result.failed_hosts | result.deferred_hosts) & down_nodes
+    except ScalingError as e:
+        print(e)
+    except Exception as e:
+        # The nodes have left the queue already, only their state tells Slurm about the failure
+        print(f"Scaling failed: {e!r}")
+    if down_nodes:
+        mark_nodes_down(down_nodes, "bibigrid scaling could not provision the node")
+
+
+async def run_power_batch(password, options):
+    suspend_nodes = set(options.suspend)
+    if suspend_nodes:
+        print(f"Suspending {len(suspend_nodes)} nodes: {', '.join(sorted(suspend_nodes))}")
+        # A node coming back under the same name is a new machine and gets provisioned again
+        forget_provisioned_hosts(suspend_nodes)
+        save_failed_hosts(load_failed_hosts() - suspend_nodes)
+        save_deferred_hosts(load_deferred_hosts() - suspend_nodes)
+    with timed_phase("resume"):
+        return await resume_nodes(password, set(options.resume), options)
+
+
+async def resume_nodes(password, nodes, options):
+    def remaining():
+        return options.resume_deadline - time.time()
+
+    if nodes:
+        print(f"Resuming {len(nodes)} nodes, {format_duration(remaining())} left: {', '.join(sorted(nodes))}")
+    missing_nodes = set(nodes)
+    hosts = {}
+    while True:
+        try:
+            data = await asyncio.to_thread(get_cluster_data, password)
+        except WrongPasswordError:
+            raise
+        except PortalRequestError as e:
+            print(f"Polling scale-data failed, trying again: {e}")
+            data = None
+        if data:
+            sync = await asyncio.to_thread(sync_cluster_data, data)
+            inventory = await asyncio.to_thread(get_inventory_hosts)
+            RUN_METRICS["hosts"] = len(inventory)
+            hosts.update({node: inventory[node] for node in missing_nodes & inventory.keys()})
+            missing_nodes -= inventory.keys()
+        if not missing_nodes and data:
+            break
+        if remaining() < FOLLOW_POLL_INTERVAL:
+            # Without any scale-data the result cannot be reported, as with a plain run
+            if not data:
+                raise PortalRequestError("No scale-data received before the ResumeTimeout")
+            print(f"Nodes not in the scale-data before the ResumeTimeout: {', '.join(sorted(missing_nodes))}")
+            break
+        if missing_nodes and data:
+            print(f"Waiting for {len(missing_nodes)} nodes to appear in the scale-data...")
+        await asyncio.sleep(FOLLOW_POLL_INTERVAL)
+
+    result = ScalingResult(sync=sync, new_hosts=set(hosts), failed_hosts=missing_nodes)
+    RUN_METRICS["new_hosts"] = len(hosts)
+    if not hosts:
+        return result
+    stale_names = get_stale_known_hosts_names(hosts, {})
+    if stale_names:
+        merge_known_hosts([], stale_names)
+    if options.skip_readiness:
+        result.deferred_hosts = set()
+    else:
+        result.deferred_hosts = await wait_for_new_hosts(
+            hosts, max(0, min(options.readiness_timeout, remaining()))
+        )
+    RUN_METRICS["deferred_hosts"] = len(result.deferred_hosts)
+    save_deferred_hosts((load_deferred_hosts() - hosts.keys()) | result.deferred_hosts)
+    ready_hosts = {host: host_vars for host, host_vars in hosts.items() if host not in result.deferred_hosts}
+    if not ready_hosts:
+        return result
+    merge_known_hosts(await scan_host_keys(ready_hosts), set())
+    fingerprints = await asyncio.to_thread(get_host_fingerprints, ready_hosts)
+    # A node is only usable once the master has it in /etc/hosts and the Slurm config
+    master_hosts = await asyncio.to_thread(get_master_hosts)
+    target_hosts = set(ready_hosts) | master_hosts
+
+    playbook_timeout = int(remaining())
+    if playbook_timeout <= 0:
+        print("No time left before the ResumeTimeout to run the playbook")
+        result.deferred_hosts |= ready_hosts.keys()
+        save_deferred_hosts(load_deferred_hosts() | result.deferred_hosts)
+        return result
+    RUN_METRICS["hosts_targeted"] = len(target_hosts)
+    update_status(hosts_total=len(target_hosts), eta=estimate_playbook_eta(len(target_hosts)))
+    provisioning = await asyncio.to_thread(
+        provision_hosts,
+        target_hosts,
+        None,
+        fingerprints,
+        replace(options, playbook_timeout=min(options.playbook_timeout or playbook_timeout, playbook_timeout)),
+    )
+    failed_hosts = target_hosts if provisioning["failed_hosts"] is None else provisioning["failed_hosts"]
+    save_failed_hosts((load_failed_hosts() - target_hosts) | failed_hosts)
+    # Nodes provisioned without the master are not usable either
+    result.failed_hosts |= set(ready_hosts) if failed_hosts & master_hosts else failed_hosts & set(ready_hosts)
+    RUN_METRICS["playbook_exit_code"] = provisioning["exit_code"]
+    result.playbook_ran = True
+    result.playbook_exit_code = provisioning["exit_code"]
+    result.playbook_attempts = len(provisioning["timings"])
+    RUN_METRICS["failed_hosts"] = len(failed_hosts)
+    return result
+
+
+def get_slurm_resume_timeout():
+    if shutil.which("scontrol"):
+        try:
+            output = subprocess.run(
+                ["scontrol", "show", "config"], capture_output=True, text=True, timeout=SLURM_HOOK_TIMEOUT
+            ).stdout
+        except (OSError, subprocess.TimeoutExpired):
+            output = ""
+        match = re.search(r"^ResumeTimeout\s*=\s*(\d+)", output, re.MULTILINE)
+        if match:
+            return int(match.group(1))
+    return SLURM_RESUME_TIMEOUT
+
+
+def mark_nodes_down(nodes, reason):
+    node_list = ",".join(sorted(nodes))
+    if not shutil.which("scontrol"):
+        print(f"scontrol not found, could not mark {node_list} down ({reason})")
+        return False
+    command = ["scontrol", "update", f"NodeName={node_list}", "State=DOWN", f"Reason={reason}"]
+    # Only SlurmUser and root may update nodes, the hooks usually run as the cluster user
+    attempts = [command] if os.geteuid() == 0 else [command, ["sudo", "-n", *command]]
+    error = ""
+    for attempt in attempts:
+        try:
+            completed = subprocess.run(
+                attempt, stdin=subprocess.DEVNULL, capture_output=True, text=True, timeout=SLURM_HOOK_TIMEOUT
+            )
+        except (OSError, subprocess.TimeoutExpired) as e:
+            error = str(e)
+            continue
+        if completed.returncode == 0:
+            print(f"Marked {node_list} down: {reason}")
+            return True
+        error = (completed.stderr or completed.stdout).strip() or f"exit code {completed.returncode}"
+    print(f"Could not mark {node_list} down ({reason}): {error}")
+    return False
+
+
+def simulate_slurm_call(action, nodes, timeout=SLURM_HOOK_TIMEOUT, wait=False, metrics_dir=PROMETHEUS_TEXTFILE_DIR):
+    context = get_context()
+    # Like slurmctld: the hostlist as the only argument, no terminal and a limited time to return
+    command = [sys.executable, os.path.abspath(__file__), "--metrics-dir", metrics_dir, "slurm", action, ",".join(nodes)]
+    log_offset = os.path.getsize(context.slurm_log_file) if os.path.exists(context.slurm_log_file) else 0
+    called = time.time()
+    started = time.monotonic()
+    try:
+        completed = subprocess.run(
+            command, stdin=subprocess.DEVNULL, capture_output=True, text=True, timeout=timeout
+        )
+    except subprocess.TimeoutExpired:
+        print(f"{action} did not return within {timeout}s")
+        return 1
+    print(completed.stdout + completed.stderr, end="")
+    print(f"{action} returned {completed.returncode} after {time.monotonic() - started:.2f}s")
+    if completed.returncode or not wait:
+        return completed.returncode
+    print("Waiting for the queued requests to be processed...")
+    while True:
+        time.sleep(1)
+        with slurm_queue() as queue:
+            pending = queue["resume"] or queue["suspend"]
+            lock_fd = os.open(context.slurm_worker_lock_file, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                worker_running = False
+            except BlockingIOError:
+                worker_running = True
+            finally:
+                os.close(lock_fd)
+        if not pending and not worker_running:
+            break
+    with open(context.slurm_log_file, "r") as f:
+        f.seek(log_offset)
+        print(f.read(), end="")
+    status = load_status() or {}
+    if status.get("started", 0) < called:
+        print("No scaling run was started for the requests")
+        return 1
+    return 0 if status["state"] == "finished" else 1
 
 
 if __name__ == "__main__":
@@ -0,0 +1,73 @@
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+import yaml
+
+# The default context of scaling.py reads its paths at import time, so they are redirected before the import
+TEST_HOME = tempfile.mkdtemp(prefix="scaling-tests-")
+os.environ["HOME"] = TEST_HOME
+os.environ["BIBIGRID_PLAYBOOK_DIR"] = os.path.join(TEST_HOME, "playbook")
+os.environ["BIBIGRID_SCALING_STATE_DIR"] = os.path.join(TEST_HOME, ".scaling")
+for variable in ("BIBIGRID_CLUSTER_NAME", "BIBIGRID_CLUSTER_ID", "BIBIGRID_PLAYBOOK_SLOTS_DIR"):
+    os.environ.pop(variable, None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import scaling  # noqa: E402
+
+
+def make_payload(workers, volumes_per_worker=2, cidr="10.0.0.0/16"):
+    hostnames = [f"bibigrid-worker-1-{index}" for index in range(1, workers + 1)]
+    return {
+        "VERSION": scaling.VERSION,
+        "groups_vars": {
+            "master": {},
+            "workers_1": {"flavor": {"name": "de.NBI large", "ram": 65536, "vcpus": 16}},
+        },
+        "host_entries": [
+            {"name": hostname, "ip": f"10.0.{index // 250}.{index % 250 + 2}"}
+            for index, hostname in enumerate(hostnames)
+        ],
+        "ansible_hosts": {
+            "all": {
+                "children": {
+                    "master": {"hosts": {"bibigrid-master-1": {"ansible_host": "10.0.0.1"}}},
+                    "workers_1": {"hosts": {hostname: {} for hostname in hostnames}},
+                }
+            }
+        },
+        "cluster_cidrs": [cidr],
+        "workers": [
+            {
+                "hostname": hostname,
+                "ip": f"10.0.{index // 250}.{index % 250 + 2}",
+                "flavor": "de.NBI large",
+                "volumes": [
+                    {"name": f"{hostname}-volume-{volume}", "size": 100, "mountpoint": f"/vol/{volume}"}
+                    for volume in range(volumes_per_worker)
+                ],
+            }
+            for index, hostname in enumerate(hostnames)
+        ],
+    }
+
+
+def create_playbook_dir(context):
+    for directory in (context.playbook_dir, context.state_dir):
+        shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(context.playbook_vars_dir)
+    os.makedirs(context.group_vars_dir)
+    os.makedirs(context.host_vars_dir)
+    with open(context.common_vars_file, "w") as f:
+        f.write(yaml.safe_dump({"cluster_cidrs": [{"provider_cidrs": ["10.0.0.0/16"]}]}))
+
+
+@pytest.fixture(autouse=True)
+def clean_state():
+    create_playbook_dir(scaling.get_context())
+    scaling.reset_run_metrics()
+    yield
+    scaling.PENDING_CHANGES["writes"].clear()
+    scaling.PENDING_CHANGES["deletes"].clear()
@@ -0,0 +1,62 @@
+import scaling
+from conftest import make_payload
+
+
+def test_normalize_for_diff_sorts_order_insensitive_lists_only():
+    value = {"cluster_cidrs": ["10.1.0.0/16", "10.0.0.0/16"], "mounts": ["/b", "/a"]}
+
+    normalized = scaling.normalize_for_diff(value)
+
+    assert normalized == {"cluster_cidrs": ["10.0.0.0/16", "10.1.0.0/16"], "mounts": ["/b", "/a"]}
+
+
+def test_normalize_for_diff_drops_ignored_fields(monkeypatch):
+    monkeypatch.setattr(scaling, "IGNORED_FIELDS", {"updated_at"})
+
+    assert scaling.normalize_for_diff({"a": 1, "updated_at": 2, "b": {"updated_at": 3}}) == {"a": 1, "b": {}}
+
+
+def test_diff_fields_reports_nested_paths():
+    old = {"flavor": {"ram": 1024, "vcpus": 2}, "image": "ubuntu"}
+    new = {"flavor": {"ram": 2048, "vcpus": 2}, "gpu": True}
+
+    assert scaling.diff_fields(old, new) == ["changed flavor.ram", "added gpu", "removed image"]
+
+
+def test_diff_fields_reports_list_members():
+    old = {"volumes": [{"name": "v1", "size": 1}, {"name": "v2", "size": 1}]}
+    new = {"volumes": [{"name": "v3", "size": 1}, {"name": "v1", "size": 5}]}
+
+    assert scaling.diff_fields(old, new) == [
+        "changed volumes[name=v1].size",
+        "removed volumes[name=v2]",
+        "added volumes[name=v3]",
+    ]
+
+
+def test_semantic_changes_of_root_lists():
+    current_content = "- name: w1\n  ip: 10.0.0.2\n"
+    new_data = [{"name": "w2", "ip": "10.0.0.3"}, {"name": "w1", "ip": "10.0.0.2"}]
+
+    changes = scaling.get_semantic_changes(current_content, new_data, root_key="host_entries")
+
+    assert changes == ["added host_entries[name=w2]"]
+
+
+def test_semantic_changes_ignore_reordering():
+    assert scaling.get_semantic_changes("cluster_cidrs: [a, b]\n", {"cluster_cidrs": ["b", "a"]}) == []
+
+
+def test_changed_fields_belong_to_one_sync():
+    payload = make_payload(2)
+    scaling.sync_cluster_data(payload)
+
+    payload["groups_vars"]["workers_1"]["flavor"]["ram"] = 1
+    first = scaling.sync_cluster_data(payload)
+    payload["workers"][0]["volumes"][0]["size"] = 200
+    second = scaling.sync_cluster_data(payload)
+
+    assert first.changed_fields == ["group_vars/workers_1.yaml: changed flavor.ram"]
+    assert second.changed_fields == [
+        "host_vars/bibigrid-worker-1-1.yaml: changed volumes[name=bibigrid-worker-1-1-volume-0].size"
+    ]
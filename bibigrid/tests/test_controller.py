@@ -0,0 +1,47 @@
+import asyncio
+import os
+
+import pytest
+import yaml
+
+import scaling
+from conftest import TEST_HOME
+
+
+def write_controller_config(tmp_path, clusters):
+    config_file = tmp_path / "controller.yaml"
+    config_file.write_text(yaml.safe_dump({"clusters": clusters}))
+    return str(config_file)
+
+
+def test_controller_config_rejects_empty_password_file(tmp_path):
+    password_file = tmp_path / "password"
+    password_file.write_text("\n")
+    os.chmod(password_file, 0o600)
+    config_file = write_controller_config(
+        tmp_path,
+        [{"name": "a", "cluster_id": "a1", "playbook_dir": TEST_HOME, "password_file": str(password_file)}],
+    )
+
+    with pytest.raises(scaling.ControllerConfigError, match="password_file: missing or empty"):
+        scaling.load_controller_config(config_file)
+
+
+def test_controller_keeps_running_other_clusters(monkeypatch, tmp_path):
+    async def run_cluster(cluster, config):
+        if cluster["name"] == "a":
+            raise scaling.ControllerConfigError("The password file of a is missing or empty")
+        return 0
+
+    monkeypatch.setattr(scaling, "run_cluster", run_cluster)
+    config_file = write_controller_config(
+        tmp_path,
+        [
+            {"name": "a", "cluster_id": "a1", "playbook_dir": TEST_HOME},
+            {"name": "b", "cluster_id": "b1", "playbook_dir": TEST_HOME},
+        ],
+    )
+
+    results = asyncio.run(scaling.run_controller(scaling.load_controller_config(config_file), once=True))
+
+    assert results == {"a": None, "b": 0}
@@ -0,0 +1,25 @@
+import asyncio
+
+import scaling
+from conftest import make_payload
+
+
+def test_follow_records_workers_of_a_crashed_batch(monkeypatch):
+    payload = make_payload(2)
+
+    async def no_host_keys(hosts):
+        return []
+
+    def crash(*args, **kwargs):
+        raise OSError("bibiplay not found")
+
+    monkeypatch.setattr(scaling, "FOLLOW_POLL_INTERVAL", 0)
+    monkeypatch.setattr(scaling, "get_cluster_data", lambda password: payload)
+    monkeypatch.setattr(scaling, "scan_host_keys", no_host_keys)
+    monkeypatch.setattr(scaling, "provision_hosts", crash)
+    options = scaling.ScalingOptions(skip_readiness=True, follow=2)
+
+    new_hosts = asyncio.run(scaling.follow_new_workers("password", options))
+
+    assert set(new_hosts) == {"bibigrid-worker-1-1", "bibigrid-worker-1-2"}
+    assert scaling.load_failed_hosts() == set(new_hosts)
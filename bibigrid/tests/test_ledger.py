@@ -0,0 +1,15 @@
+import scaling
+from conftest import make_payload
+
+
+def test_fingerprints_change_with_cluster_membership():
+    payload = make_payload(2)
+    scaling.sync_cluster_data(payload)
+    fingerprints = scaling.get_host_fingerprints(scaling.get_inventory_hosts())
+    scaling.record_provisioned_hosts(fingerprints, set(fingerprints))
+    assert scaling.get_converged_hosts(fingerprints) == set(fingerprints)
+
+    payload["host_entries"].append({"name": "bibigrid-worker-1-3", "ip": "10.0.0.9"})
+    scaling.sync_cluster_data(payload)
+
+    assert scaling.get_converged_hosts(scaling.get_host_fingerprints(scaling.get_inventory_hosts())) == set()
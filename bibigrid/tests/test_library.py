@@ -0,0 +1,61 @@
+import asyncio
+import os
+
+import scaling
+from conftest import TEST_HOME, create_playbook_dir, make_payload
+
+
+def test_scale_async_keeps_clusters_apart(monkeypatch, tmp_path):
+    payloads = {"a": make_payload(2), "b": make_payload(3)}
+    playbook_runs = []
+
+    async def no_host_keys(hosts):
+        return []
+
+    async def no_control_connections(hosts):
+        pass
+
+    def run_playbook(excluded_hosts=(), limit_hosts=None, **supervision):
+        context = scaling.get_context()
+        hosts = set(scaling.get_inventory_hosts()) - set(excluded_hosts)
+        playbook_runs.append((context.cluster_name, os.path.basename(context.playbook_dir), len(hosts)))
+        return 0, {"tasks": [], "stats": {host: {"failures": 0, "unreachable": 0} for host in hosts}}
+
+    monkeypatch.setattr(
+        scaling, "get_cluster_data", lambda password: payloads[scaling.get_context().cluster_name]
+    )
+    monkeypatch.setattr(scaling, "scan_host_keys", no_host_keys)
+    monkeypatch.setattr(scaling, "open_control_connections", no_control_connections)
+    monkeypatch.setattr(scaling, "run_ansible_playbook", run_playbook)
+    contexts = {
+        name: scaling.ScalingContext(
+            os.path.join(TEST_HOME, f"playbook-{name}"), os.path.join(TEST_HOME, f".scaling-{name}"), name
+        )
+        for name in payloads
+    }
+    for context in contexts.values():
+        create_playbook_dir(context)
+
+    async def scale_clusters():
+        # Both runs share the caller's event loop
+        options = scaling.ScalingOptions(skip_readiness=True, progress=False)
+        return await asyncio.gather(
+            *(
+                scaling.scale_async("password", options, metrics_dir=str(tmp_path), context=context)
+                for context in contexts.values()
+            )
+        )
+
+    results = asyncio.run(scale_clusters())
+
+    assert [result.sync.workers for result in results] == [2, 3]
+    assert all(result.success for result in results)
+    assert sorted(playbook_runs) == [("a", "playbook-a", 3), ("b", "playbook-b", 4)]
+    assert contexts["a"].metrics["workers"] == 2
+    assert contexts["b"].metrics["workers"] == 3
+    # The default context of this host is left alone
+    assert scaling.RUN_METRICS["workers"] == 0
+    for name, context in contexts.items():
+        assert os.path.exists(os.path.join(context.host_vars_dir, "bibigrid-worker-1-2.yaml"))
+        assert os.path.exists(os.path.join(tmp_path, f"bibigrid_scaling_{name}.prom"))
+        assert scaling.load_status(context.status_file)["state"] == "finished"
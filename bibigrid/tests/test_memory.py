@@ -0,0 +1,39 @@
+import tracemalloc
+
+import pytest
+
+import scaling
+from conftest import make_payload
+
+# Peak traced memory of one sync, kept at about twice what it takes today
+MEMORY_BOUNDS = {1000: 6 * 1024 * 1024, 10000: 48 * 1024 * 1024}
+
+
+def trace_sync(payload):
+    scaling.reset_run_metrics(trace_memory=True)
+    try:
+        with scaling.timed_phase("sync"):
+            result = scaling.sync_cluster_data(payload)
+    finally:
+        scaling.finish_memory_tracing()
+    assert not tracemalloc.is_tracing()
+    return result
+
+
+@pytest.mark.parametrize("workers", sorted(MEMORY_BOUNDS))
+def test_initial_sync_peak_memory(workers):
+    result = trace_sync(make_payload(workers))
+
+    assert result.changed
+    assert result.workers == workers
+    assert 0 < scaling.RUN_METRICS["peak_memory"] <= MEMORY_BOUNDS[workers]
+
+
+@pytest.mark.parametrize("workers", sorted(MEMORY_BOUNDS))
+def test_unchanged_sync_peak_memory(workers):
+    scaling.sync_cluster_data(make_payload(workers))
+
+    result = trace_sync(make_payload(workers))
+
+    assert not result.changed
+    assert 0 < scaling.RUN_METRICS["peak_memory"] <= MEMORY_BOUNDS[workers]
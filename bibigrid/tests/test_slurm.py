@@ -0,0 +1,62 @@
+import subprocess
+import time
+
+import pytest
+
+import scaling
+
+
+@pytest.mark.parametrize(
+    "expression, names",
+    [
+        ("w1", ["w1"]),
+        ("w[1-3]", ["w1", "w2", "w3"]),
+        ("w-[08-10,12]", ["w-08", "w-09", "w-10", "w-12"]),
+        ("a[1-2]-[1-2],b", ["a1-1", "a1-2", "a2-1", "a2-2", "b"]),
+        ("w1,w1", ["w1"]),
+    ],
+)
+def test_expand_hostlist(expression, names):
+    assert scaling.expand_hostlist(expression) == names
+
+
+@pytest.mark.parametrize("expression", ["w[1-", "w]1[", "w[x]", "w[[1]]", "not a host"])
+def test_expand_hostlist_rejects_invalid_expressions(expression):
+    with pytest.raises(scaling.HostlistError):
+        scaling.expand_hostlist(expression)
+
+
+def test_process_slurm_batch_marks_nodes_down_after_any_error(monkeypatch):
+    marked = []
+
+    def scale(*args, **kwargs):
+        raise RuntimeError("unexpected")
+
+    monkeypatch.setattr(scaling, "resolve_password", lambda interactive: "password")
+    monkeypatch.setattr(scaling, "get_slurm_resume_timeout", lambda: scaling.SLURM_RESUME_TIMEOUT)
+    monkeypatch.setattr(scaling, "scale", scale)
+    monkeypatch.setattr(scaling, "mark_nodes_down", lambda nodes, reason: marked.append(set(nodes)))
+
+    scaling.process_slurm_batch({"w1": time.time(), "w2": time.time()}, {})
+
+    assert marked == [{"w1", "w2"}]
+
+
+def test_mark_nodes_down_reports_failure(monkeypatch, capsys):
+    commands = []
+
+    def run(command, **kwargs):
+        commands.append(command)
+        return subprocess.CompletedProcess(command, 1, "", "Invalid user for SlurmUser\n")
+
+    monkeypatch.setattr(scaling.shutil, "which", lambda name: f"/usr/bin/{name}")
+    monkeypatch.setattr(scaling.os, "geteuid", lambda: 1000)
+    monkeypatch.setattr(scaling.subprocess, "run", run)
+
+    assert not scaling.mark_nodes_down({"w2", "w1"}, "failed")
+
+    assert [command[:3] for command in commands] == [
+        ["scontrol", "update", "NodeName=w1,w2"],
+        ["sudo", "-n", "scontrol"],
+    ]
+    assert "Could not mark w1,w2 down (failed): Invalid user for SlurmUser" in capsys.readouterr().out
@@ -0,0 +1,57 @@
+import base64
+import hashlib
+import hmac
+
+import pytest
+
+import scaling
+
+
+def hashed_name(name, salt=b"0123456789abcdefghij"):
+    digest = hmac.new(salt, name.encode(), hashlib.sha1).digest()
+    return f"|1|{base64.b64encode(salt).decode()}|{base64.b64encode(digest).decode()}"
+
+
+@pytest.mark.parametrize(
+    "line, names, matches",
+    [
+        ("10.0.0.2 ssh-ed25519 AAAA", {"10.0.0.2"}, True),
+        ("w1,10.0.0.2 ssh-ed25519 AAAA", {"w1"}, True),
+        ("10.0.0.3 ssh-ed25519 AAAA", {"10.0.0.2"}, False),
+        ("[10.0.0.2]:22 ssh-ed25519 AAAA", {"10.0.0.2"}, True),
+        ("[10.0.0.2]:2222 ssh-ed25519 AAAA", {"10.0.0.2"}, False),
+        ("[10.0.0.2]:2222 ssh-ed25519 AAAA", {"[10.0.0.2]:2222"}, True),
+        ("@cert-authority 10.0.0.2 ssh-ed25519 AAAA", {"10.0.0.2"}, True),
+        (f"{hashed_name('10.0.0.2')} ssh-ed25519 AAAA", {"10.0.0.2"}, True),
+        (f"{hashed_name('10.0.0.2')} ssh-ed25519 AAAA", {"10.0.0.3"}, False),
+        ("# 10.0.0.2 ssh-ed25519 AAAA", {"10.0.0.2"}, False),
+    ],
+)
+def test_known_hosts_line_matches(line, names, matches):
+    assert scaling.known_hosts_line_matches(line, names) is matches
+
+
+def configure_control_path(monkeypatch, tmp_path, config):
+    config_file = tmp_path / "ansible.cfg"
+    config_file.write_text(config)
+    monkeypatch.setattr(scaling, "find_ansible_config", lambda: str(config_file))
+    monkeypatch.setattr(scaling, "find_mitogen_strategy_plugins", lambda: None)
+    for variable in ("ANSIBLE_SSH_CONTROL_PATH", "ANSIBLE_SSH_CONTROL_PATH_DIR"):
+        monkeypatch.delenv(variable, raising=False)
+    environment, _, _ = scaling.configure_acceleration(set())
+    return environment
+
+
+def test_control_path_reuses_readiness_sockets(monkeypatch, tmp_path):
+    environment = configure_control_path(monkeypatch, tmp_path, "[defaults]\n")
+
+    assert environment["ANSIBLE_SSH_CONTROL_PATH_DIR"] == scaling.SSH_CONTROL_DIR
+    assert environment["ANSIBLE_SSH_CONTROL_PATH"] == "%(directory)s/%%C"
+
+
+@pytest.mark.parametrize("option", ["control_path", "control_path_dir"])
+def test_control_path_keeps_ansible_cfg_setting(monkeypatch, tmp_path, option):
+    environment = configure_control_path(monkeypatch, tmp_path, f"[ssh_connection]\n{option} = /tmp/cp\n")
+
+    assert "ANSIBLE_SSH_CONTROL_PATH" not in environment
+    assert "ANSIBLE_SSH_CONTROL_PATH_DIR" not in environment
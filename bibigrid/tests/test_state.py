@@ -0,0 +1,75 @@
+import os
+
+import scaling
+from conftest import make_payload
+
+
+def record_state(payload, full_sync=False):
+    store = scaling.open_state_store()
+    with store:
+        changes = scaling.record_cluster_state(
+            store, payload, scaling.build_worker_records(payload["workers"]), full_sync=full_sync
+        )
+    store.close()
+    return changes
+
+
+def test_record_cluster_state_tracks_changes_per_record():
+    payload = make_payload(3)
+    # The first generation has nothing to compare against
+    assert record_state(payload) is None
+    assert scaling.RUN_METRICS["generation"] == 1
+
+    payload["workers"][0]["volumes"][0]["size"] = 200
+    del payload["workers"][2]
+    payload["groups_vars"]["workers_1"]["flavor"]["ram"] = 1
+    changes = record_state(payload)
+
+    assert scaling.RUN_METRICS["generation"] == 2
+    assert changes["volumes"] == {"changed": {"bibigrid-worker-1-1"}, "removed": {"bibigrid-worker-1-3"}}
+    assert changes["worker"] == {"changed": set(), "removed": {"bibigrid-worker-1-3"}}
+    assert changes["group_vars"] == {"changed": {"workers_1"}, "removed": set()}
+    assert changes["host_entries"] == {"changed": set(), "removed": set()}
+
+
+def test_record_cluster_state_ignores_reordering():
+    payload = make_payload(3)
+    record_state(payload)
+
+    payload["cluster_cidrs"] = list(reversed(payload["cluster_cidrs"] + ["10.1.0.0/16"]))
+    record_state(payload)
+    payload["cluster_cidrs"].reverse()
+    changes = record_state(payload)
+
+    assert scaling.RUN_METRICS["generation"] == 2
+    assert all(not kind["changed"] and not kind["removed"] for kind in changes.values())
+
+
+def test_record_cluster_state_full_sync_exports_everything():
+    payload = make_payload(2)
+    record_state(payload)
+
+    assert record_state(payload, full_sync=True) is None
+
+
+def test_sync_after_rollback_removes_restored_host_vars():
+    payload = make_payload(3)
+    scaling.sync_cluster_data(payload)
+    del payload["workers"][2]
+    scaling.sync_cluster_data(payload)
+    removed_file = os.path.join(scaling.get_context().host_vars_dir, "bibigrid-worker-1-3.yaml")
+    assert not os.path.exists(removed_file)
+
+    assert scaling.rollback_generation()
+    scaling.invalidate_state_store()
+    assert os.path.exists(removed_file)
+
+    result = scaling.sync_cluster_data(payload)
+
+    assert result.changed
+    assert not os.path.exists(removed_file)
+    # Only the first sync after the rollback compares every file
+    assert record_state(payload) == {
+        kind: {"changed": set(), "removed": set()}
+        for kind in ("ansible_hosts", "host_entries", "cluster_cidrs", "group_vars", "worker", "volumes")
+    }
@@ -0,0 +1,33 @@
+import pytest
+
+import scaling
+from conftest import make_payload
+
+
+def test_validate_scale_data_accepts_synthetic_payload():
+    scaling.validate_scale_data(make_payload(3))
+
+
+def test_validate_scale_data_collects_all_problems():
+    payload = make_payload(2)
+    payload["workers"].append({"hostname": payload["workers"][0]["hostname"]})
+    payload["workers"].append({"hostname": "not a hostname", "volumes": "none"})
+    payload["cluster_cidrs"] = ["10.0.0.0/33"]
+    payload["groups_vars"]["bad group"] = []
+
+    with pytest.raises(scaling.PayloadValidationError) as error:
+        scaling.validate_scale_data(payload)
+
+    assert error.value.problems == [
+        "workers[2].hostname is duplicated: bibigrid-worker-1-1",
+        "workers[3].hostname is not a valid hostname: 'not a hostname'",
+        "workers[3].volumes must be a list",
+        "cluster_cidrs[0] is not a valid CIDR: '10.0.0.0/33'",
+        "groups_vars has an invalid group name: 'bad group'",
+        "groups_vars.bad group must be an object",
+    ]
+
+
+def test_validate_scale_data_rejects_non_objects():
+    with pytest.raises(scaling.PayloadValidationError):
+        scaling.validate_scale_data([])
@@ -0,0 +1,19 @@
+import scaling
+
+
+def test_watchdog_cuts_off_host_stalled_in_first_task(monkeypatch):
+    terminated = []
+    monkeypatch.setattr(
+        scaling, "terminate_host_connections", lambda pid, address: terminated.append(address) or True
+    )
+
+    class Process:
+        pid = 1
+
+    watchdog = scaling.PlaybookWatchdog(Process(), 10, {"w2": "10.0.0.3"}, {"w1", "w2", "w3"})
+    for line in ("PLAY [all]", "TASK [Gathering Facts]", "ok: [w1]", "ok: [w3]"):
+        watchdog.feed(line)
+
+    assert watchdog.check(watchdog.task_started + 5) == []
+    assert len(watchdog.check(watchdog.task_started + 11)) == 1
+    assert terminated == ["10.0.0.3"]